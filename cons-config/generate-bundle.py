@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+"""
+Combine beagle.json, master.json and app.json into bundle.json, so that the entry scripts start with a single
+download. Use 'make bundle' or 'make publish', which rebuild it whenever one of the files is newer: a stale bundle
+takes precedence over the separate files.
+"""
+import json
+
+from zerg.common import BUNDLE_KEYS
+
+if __name__ == '__main__':
+    bundle = {}
+    for name, key in BUNDLE_KEYS.items():
+        with open('.' + name, 'r') as _f:
+            bundle[key] = json.load(_f)
+
+    with open('bundle.json', 'w+') as _f:
+        json.dump(bundle, _f, sort_keys=True)
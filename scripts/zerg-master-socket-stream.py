@@ -29,16 +29,14 @@ if __name__ == '__main__':
     app_config = zerg.common.get_application_config(app)
     stream_config = zerg.common.StreamConfig(app_config['stream'], application=app)
 
-    redis_manager = zerg.common.RedisManager(
-        ip=redis_config['ip'], port=redis_config['port'], db=redis_config['db'],
-        stream_name=endpoint)
-
-    zerg.master.STREAMSocketMaster(redis_manager=redis_manager,
-                                   socket_path=socket_path,
-                                   socket_read_payload_length=stream_config.read_payload_length,
-                                   socket_reconnect_interval=stream_config.reconnect_interval,
-                                   socket_terminator=zerg.common.get_terminator_bytes(stream_config.terminator),
-                                   socket_timeout=stream_config.timeout,
-                                   socket_buffer=stream_config.buffer,
-                                   socket_trim_terminator=stream_config.trim_terminator,
-                                   ).start()
+    redis_manager = zerg.common.RedisManager.from_config(redis_config, app_config, endpoint)
+    admission = zerg.master.AdmissionController.from_config(app_config['admission'])
+
+    zerg.common.exit_on_sigterm()
+    try:
+        zerg.master.STREAMSocketMaster(redis_manager=redis_manager,
+                                       admission=admission,
+                                       socket_path=socket_path,
+                                       **stream_config.socket_settings()).start()
+    finally:
+        redis_manager.stats.close()
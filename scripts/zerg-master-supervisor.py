@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+import argparse
+import functools
+import logging
+
+import zerg.common
+import zerg.master
+
+
+def start_master(app: str, endpoint: str, socket_path: str):
+    """ Worker body, runs in the forked child. """
+    redis_config = zerg.common.get_application_config('the-overmind')
+    app_config = zerg.common.get_application_config(app)
+    stream_config = zerg.common.StreamConfig(app_config['stream'], application=app)
+
+    redis_manager = zerg.common.RedisManager.from_config(redis_config, app_config, endpoint)
+    admission = zerg.master.AdmissionController.from_config(app_config['admission'])
+
+    try:
+        zerg.master.STREAMSocketMaster(redis_manager=redis_manager,
+                                       admission=admission,
+                                       socket_path=socket_path,
+                                       **stream_config.socket_settings()).start()
+    finally:
+        redis_manager.stats.close()
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger()
+
+    parser = argparse.ArgumentParser("IOC side - Many pipeline connections from one warmed up interpreter")
+    parser.add_argument('app', type=str, choices=['uhv', 'mks'])
+    parser.add_argument('masters', type=str, nargs='+', metavar='endpoint=socket_path')
+    parser.add_argument('--respawn-interval', type=float, default=1.)
+
+    parser.add_argument('--logging-level', type=str, default='info',
+                        choices=['notset', 'debug', 'info', 'warning', 'error', 'critical'])
+
+    args = parser.parse_args()
+
+    zerg.common.log_config(level=zerg.common.get_log_level(args.logging_level))
+
+    # Download the configuration once, the children inherit it
+    zerg.common.get_application_config('the-overmind')
+    for endpoint in (m.split('=', 1)[0] for m in args.masters):
+        zerg.common.get_master_data(args.app, endpoint)
+
+    workers = {}
+    for m in args.masters:
+        endpoint, socket_path = m.split('=', 1)
+        workers[endpoint] = functools.partial(start_master, args.app, endpoint, socket_path)
+
+    zerg.master.supervise(workers, respawn_interval=args.respawn_interval)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+
+import zerg.common
+import zerg.master
+
+if __name__ == '__main__':
+    logger = logging.getLogger()
+
+    parser = argparse.ArgumentParser("IOC side - Pipeline connections over TCP")
+    parser.add_argument('app', type=str, choices=['uhv', 'mks'])
+    parser.add_argument('--host', type=str, default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--no-nodelay', action='store_true', help='Keep Nagle\'s algorithm enabled.')
+    parser.add_argument('--no-keepalive', action='store_true', help='Disable TCP keep-alive.')
+
+    parser.add_argument('--logging-level', type=str, default='info',
+                        choices=['notset', 'debug', 'info', 'warning', 'error', 'critical'])
+
+    args = parser.parse_args()
+
+    app = args.app
+
+    zerg.common.log_config(level=zerg.common.get_log_level(args.logging_level))
+
+    redis_config = zerg.common.get_application_config('the-overmind')
+    master_settings = zerg.common.get_master_settings()
+    app_config = zerg.common.get_application_config(app)
+    stream_config = zerg.common.StreamConfig(app_config['stream'], application=app)
+
+    def redis_manager_factory(endpoint: str):
+        return zerg.common.RedisManager.from_config(redis_config, app_config, endpoint)
+
+    zerg.master.STREAMTCPMaster(host=args.host,
+                                port=args.port,
+                                redis_manager_factory=redis_manager_factory,
+                                endpoints=list(master_settings[app].keys()),
+                                admission=zerg.master.AdmissionController.from_config(app_config['admission']),
+                                tcp_nodelay=not args.no_nodelay,
+                                tcp_keepalive=not args.no_keepalive,
+                                **stream_config.socket_settings()).start()
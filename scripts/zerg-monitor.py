@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+
+import redis
+
+import zerg.common
+import zerg.monitor
+
+if __name__ == '__main__':
+    logger = logging.getLogger()
+
+    parser = argparse.ArgumentParser("Live endpoint traffic monitor")
+    parser.add_argument('patterns', type=str, nargs='+', help='Endpoint glob patterns, e.g. \'uhv:*\'.')
+    parser.add_argument('--interval', type=float, default=1., help='Seconds between rate reports.')
+    parser.add_argument('--payloads', action='store_true', help='Show every request/reply summary.')
+    parser.add_argument('--redis-ip', type=str, default=None, help='Override the configured redis ip.')
+    parser.add_argument('--redis-port', type=int, default=None, help='Override the configured redis port.')
+    parser.add_argument('--redis-db', type=int, default=None, help='Override the configured redis db.')
+
+    parser.add_argument('--logging-level', type=str, default='info',
+                        choices=['notset', 'debug', 'info', 'warning', 'error', 'critical'])
+
+    args = parser.parse_args()
+
+    zerg.common.log_config(level=zerg.common.get_log_level(args.logging_level))
+
+    if args.redis_ip is None or args.redis_port is None or args.redis_db is None:
+        redis_config = zerg.common.get_application_config('the-overmind')
+    else:
+        redis_config = {}
+
+    connection = redis.Redis(
+        host=args.redis_ip if args.redis_ip is not None else redis_config['ip'],
+        port=args.redis_port if args.redis_port is not None else redis_config['port'],
+        db=args.redis_db if args.redis_db is not None else redis_config['db'])
+
+    try:
+        zerg.monitor.monitor(connection, args.patterns, interval=args.interval, show_payloads=args.payloads)
+    except KeyboardInterrupt:
+        pass
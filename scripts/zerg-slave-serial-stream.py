@@ -20,20 +20,22 @@ if __name__ == '__main__':
     beagle_config = zerg.common.get_beagle_config()
     app_config = zerg.common.get_application_config(beagle_config.app)
 
-    redis_manager = zerg.common.RedisManager(
-        ip=redis_config['ip'], port=redis_config['port'], db=redis_config['db'],
-        stream_name=beagle_config.endpoint)
-
-    zerg.slave.SerialSlave(redis_manager=redis_manager,
-                           client_id=beagle_config.ip,
-                           priority=beagle_config.priority,
-                           serial_baudrate=app_config['serial']['baudrate'],
-                           serial_buffer=app_config['serial']['buffer'],
-                           serial_device=app_config['serial']['device'],
-                           serial_operation_timeout=app_config['serial']['operation_timeout'],
-                           serial_read_terminator=
-                                zerg.common.get_terminator_bytes(app_config['serial']['read_terminator']),
-                           serial_read_timeout=app_config['serial']['read_timeout'],
-                           serial_write_timeout=app_config['serial']['write_timeout'],
-                           ).start()
-
+    redis_manager = zerg.common.RedisManager.from_config(redis_config, app_config, beagle_config.endpoint)
+
+    zerg.common.exit_on_sigterm()
+    try:
+        zerg.slave.SerialSlave(redis_manager=redis_manager,
+                               client_id=beagle_config.ip,
+                               priority=beagle_config.priority,
+                               serial_baudrate=app_config['serial']['baudrate'],
+                               serial_buffer=app_config['serial']['buffer'],
+                               serial_device=app_config['serial']['device'],
+                               serial_operation_timeout=app_config['serial']['operation_timeout'],
+                               serial_read_terminator=
+                                    zerg.common.get_terminator_bytes(app_config['serial']['read_terminator']),
+                               serial_read_timeout=app_config['serial']['read_timeout'],
+                               serial_write_timeout=app_config['serial']['write_timeout'],
+                               serial_frame=app_config['serial'].get('frame'),
+                               ).start()
+    finally:
+        redis_manager.stats.close()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+
+import redis
+
+import zerg.common
+import zerg.stats
+
+if __name__ == '__main__':
+    logger = logging.getLogger()
+
+    parser = argparse.ArgumentParser("Endpoint capacity-planning report")
+    parser.add_argument('--window', type=float, default=3600., help='Seconds covered by the report.')
+    parser.add_argument('--role', type=str, default='slave', choices=zerg.stats.ROLES,
+                        help='slave: bus utilization and device latency, master: end to end figures.')
+    parser.add_argument('--top', type=int, default=20, help='Number of endpoints listed.')
+    parser.add_argument('--redis-ip', type=str, default=None, help='Override the configured redis ip.')
+    parser.add_argument('--redis-port', type=int, default=None, help='Override the configured redis port.')
+    parser.add_argument('--redis-db', type=int, default=None, help='Override the configured redis db.')
+
+    parser.add_argument('--logging-level', type=str, default='info',
+                        choices=['notset', 'debug', 'info', 'warning', 'error', 'critical'])
+
+    args = parser.parse_args()
+
+    zerg.common.log_config(level=zerg.common.get_log_level(args.logging_level))
+
+    redis_config = zerg.common.get_application_config('the-overmind')
+
+    connection = redis.Redis(
+        host=args.redis_ip if args.redis_ip is not None else redis_config['ip'],
+        port=args.redis_port if args.redis_port is not None else redis_config['port'],
+        db=args.redis_db if args.redis_db is not None else redis_config['db'])
+
+    reports = zerg.stats.report(connection, window=args.window, bucket=redis_config['stats']['bucket'],
+                                role=args.role, top=args.top)
+
+    print('{:<24} {:>8} {:>8} {:>7} {:>8} {:>8} {:>8} {:>6} {:>12} {:>12}'.format(
+        'endpoint', 'requests', 'req/s', 'util%', 'p50 ms', 'p99 ms', 'timeouts', 'shed', 'bytes in', 'bytes out'))
+    for r in reports:
+        print('{:<24} {:>8} {:>8.2f} {:>7.1f} {:>8} {:>8} {:>8} {:>6} {:>12} {:>12}'.format(
+            r.endpoint, r.count, r.count / r.window, r.utilization * 100, r.percentile(0.5), r.percentile(0.99),
+            r.fields.get('timeouts', 0), r.shed,
+            r.fields.get('bytes_in', 0), r.fields.get('bytes_out', 0)))
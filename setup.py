@@ -28,6 +28,10 @@ setup(
     scripts=[
         'scripts/zerg-master-socket-stream.py',
         'scripts/zerg-slave-serial-stream.py',
+        'scripts/zerg-master-tcp-stream.py',
+        'scripts/zerg-monitor.py',
+        'scripts/zerg-master-supervisor.py',
+        'scripts/zerg-stats-report.py',
     ],
     include_package_data=True,
     zip_safe=False
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Per-transaction overhead of SerialSlave.downstream_action over a pty.
+
+A thread plays the device on the pty master side and echoes every request back. The same slave is measured with the
+cached read profile and with the previous behaviour (settings re-parsed, profile recompiled, output flushed and port
+timeout reassigned on every transaction).
+
+    PYTHONPATH=. python test/bench_serial_slave.py --count 2000
+"""
+import argparse
+import ast
+import os
+import threading
+import time
+import tty
+
+import zerg.slave
+
+SETTINGS = b"{'Terminator': '\\r\\n', 'ReplyTimeout': 1000, 'ReadTimeout': 500, 'MaxInput': 64}"
+
+
+class DummyRedisManager:
+    def __init__(self):
+        self.slave_priority = None
+        self.monitor = type('Monitor', (), {})()
+        self.stats = type('Stats', (), {})()
+
+
+class UncachedSerialSlave(zerg.slave.SerialSlave):
+    """ Per-request reconfiguration, as done before the read profile cache. """
+
+    def get_read_profile(self, settings: dict):
+        self.ser.flushOutput()
+        return zerg.slave.ReadProfile(ast.literal_eval(SETTINGS.decode('utf-8')),
+                                      operation_timeout=self.serial_operation_timeout,
+                                      read_timeout=self.serial_read_timeout,
+                                      terminator=self.serial_read_terminator)
+
+    def apply_read_profile(self, profile):
+        self.ser.timeout = profile.read_timeout
+
+
+def device(fd: int):
+    """ Echo each CRLF terminated request. """
+    buffer = b''
+    while True:
+        try:
+            buffer += os.read(fd, 256)
+        except OSError:
+            return
+        while b'\r\n' in buffer:
+            line, buffer = buffer.split(b'\r\n', 1)
+            os.write(fd, line + b'\r\n')
+
+
+def run(slave, settings, count: int):
+    tini = time.perf_counter()
+    for i in range(count):
+        reply = slave.downstream_action(b'#0001I%d\r\n' % i, settings)
+        assert reply.endswith(b'\r\n'), reply
+    return (time.perf_counter() - tini) / count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("SerialSlave per-transaction overhead")
+    parser.add_argument('--count', type=int, default=2000)
+    args = parser.parse_args()
+
+    master_fd, slave_fd = os.openpty()
+    tty.setraw(master_fd)
+    threading.Thread(target=device, args=(master_fd,), daemon=True).start()
+    device_name = os.ttyname(slave_fd)
+
+    settings = ast.literal_eval(SETTINGS.decode('utf-8'))
+    results = {}
+    for name, cls in (('uncached', UncachedSerialSlave), ('cached', zerg.slave.SerialSlave)):
+        slave = cls(DummyRedisManager(), client_id='bench', priority='high',
+                    serial_device=device_name, serial_baudrate=115200)
+        slave.connect(retry=False)
+        run(slave, settings, 100)
+        results[name] = run(slave, settings, args.count)
+        slave.ser.close()
+        print('{:>10}: {:.1f} us/transaction'.format(name, results[name] * 1e6))
+
+    print('{:>10}: {:.1f} us/transaction'.format('saved', (results['uncached'] - results['cached']) * 1e6))
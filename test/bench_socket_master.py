@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Round trip through the master over the unix socket and over TCP.
+
+Redis is replaced by an in-process echo so only the socket side is measured: framing, settings handling and
+admission control are the real ones.
+
+    PYTHONPATH=. python test/bench_socket_master.py --count 20000
+"""
+import argparse
+import os
+import socket
+import statistics
+import tempfile
+import threading
+import time
+
+import zerg.master
+
+TERMINATOR = b'\r\n'
+ENDPOINT = 'uhv:bench'
+
+
+class EchoRedisManager:
+    """ Answers every request with its payload. """
+
+    def __init__(self, endpoint: str = ENDPOINT):
+        self.stream_name = endpoint
+        self.upstream_timeout = 1.
+        self.stats = type('Stats', (), {'record_shed': lambda self: None, 'close': lambda self: None})()
+
+    def master_sync_send_receive(self, data, settings: bytes = b'{}'):
+        return data
+
+    def report(self, request: bytes, reply: bytes, latency: float):
+        pass
+
+
+def round_trips(s: socket.socket, count: int):
+    samples = []
+    buffer = b''
+    for i in range(count):
+        request = b'#0001I%d' % i + TERMINATOR
+        tini = time.perf_counter()
+        s.sendall(request)
+        while not buffer.endswith(TERMINATOR):
+            buffer += s.recv(4096)
+        samples.append(time.perf_counter() - tini)
+        assert buffer == request, buffer
+        buffer = b''
+    return samples
+
+
+def report(name: str, samples: list):
+    samples = sorted(samples)
+    print('{:>5}: median {:.1f} us, p99 {:.1f} us'.format(
+        name, statistics.median(samples) * 1e6, samples[int(len(samples) * 0.99)] * 1e6))
+    return statistics.median(samples)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Unix socket versus TCP master round trip")
+    parser.add_argument('--count', type=int, default=20000)
+    parser.add_argument('--port', type=int, default=15000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        socket_path = os.path.join(directory, 'master.sock')
+        unix_master = zerg.master.STREAMSocketMaster(socket_path, EchoRedisManager(), socket_terminator=TERMINATOR)
+        threading.Thread(target=unix_master.start, daemon=True).start()
+
+        tcp_master = zerg.master.STREAMTCPMaster('127.0.0.1', args.port, redis_manager_factory=EchoRedisManager,
+                                                 socket_terminator=TERMINATOR)
+        threading.Thread(target=tcp_master.start, daemon=True).start()
+
+        while not os.path.exists(socket_path):
+            time.sleep(0.01)
+        time.sleep(0.1)
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(socket_path)
+            round_trips(s, 1000)
+            unix = report('unix', round_trips(s, args.count))
+
+        with socket.create_connection(('127.0.0.1', args.port)) as s:
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            s.sendall(zerg.master.HANDSHAKE_PREFIX + ENDPOINT.encode('utf-8') + zerg.master.HANDSHAKE_SUFFIX +
+                      TERMINATOR)
+            assert s.recv(64) == zerg.master.HANDSHAKE_OK + TERMINATOR
+            round_trips(s, 1000)
+            tcp = report('tcp', round_trips(s, args.count))
+
+    print('{:>5}: {:.1f} us'.format('diff', (tcp - unix) * 1e6))
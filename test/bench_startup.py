@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Startup time of the master entry script.
+
+Import time: wall time of 'import zerg.master' in a fresh interpreter, minus an empty interpreter.
+First request: time from spawning zerg-master-socket-stream.py until the first reply through its unix socket. The
+config files are served from a temporary directory over HTTP and an echo slave runs in this process, a redis server
+is required.
+
+    PYTHONPATH=. python test/bench_startup.py --redis-ip 127.0.0.1
+"""
+import argparse
+import functools
+import http.server
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENDPOINT = 'uhv:test'
+
+
+def interpreter_time(code: str, count: int):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    samples = []
+    for _ in range(count):
+        tini = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check=True, env=env)
+        samples.append(time.perf_counter() - tini)
+    return statistics.median(samples)
+
+
+def serve_config(directory: str, redis_ip: str, redis_port: int, bundle: bool):
+    """ Copy cons-config with the redis address replaced and serve it, returns the host:port. """
+    os.makedirs(os.path.join(directory, 'cons-config'))
+    files = {}
+    for name in ('beagle.json', 'master.json', 'app.json'):
+        with open(os.path.join(ROOT, 'cons-config', name), 'r') as _f:
+            files[name] = json.load(_f)
+    files['app.json']['the-overmind'].update(ip=redis_ip, port=redis_port)
+
+    if bundle:
+        files['bundle.json'] = {'beagle': files['beagle.json'], 'master': files['master.json'],
+                                'app': files['app.json']}
+
+    for name, data in files.items():
+        with open(os.path.join(directory, 'cons-config', name), 'w+') as _f:
+            json.dump(data, _f)
+
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=directory)
+    handler.log_message = lambda *args: None
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return '127.0.0.1:{}'.format(server.server_address[1]), server
+
+
+def start_echo_slave(redis_ip: str, redis_port: int):
+    import zerg.common
+    import zerg.slave
+
+    class EchoSlave(zerg.slave.BaseSlave):
+        def downstream_action(self, downstream_data, settings={}):
+            return downstream_data
+
+    redis_manager = zerg.common.RedisManager(ENDPOINT, ip=redis_ip, port=redis_port)
+    slave = EchoSlave(redis_manager, client_id='bench')
+    threading.Thread(target=slave.start, daemon=True).start()
+
+
+def first_request(hosts: str, socket_path: str, timeout: float = 30.):
+    env = dict(os.environ, PYTHONPATH=ROOT, ZERG_CONFIG_HOSTS=hosts)
+    tini = time.perf_counter()
+    master = subprocess.Popen([sys.executable, os.path.join(ROOT, 'scripts', 'zerg-master-socket-stream.py'),
+                               'uhv', ENDPOINT, socket_path, '--logging-level', 'warning'], env=env)
+    try:
+        while time.perf_counter() - tini < timeout:
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                    s.connect(socket_path)
+                    s.sendall(b'ping\r\n')
+                    reply = s.recv(64)
+                    if reply == b'ping\r\n':
+                        return time.perf_counter() - tini
+            except (FileNotFoundError, ConnectionRefusedError):
+                pass
+            time.sleep(0.001)
+        raise TimeoutError('No reply from the master')
+    finally:
+        master.terminate()
+        master.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Entry script startup time")
+    parser.add_argument('--count', type=int, default=10)
+    parser.add_argument('--redis-ip', type=str, default=None, help='Measure the first request using this redis.')
+    parser.add_argument('--redis-port', type=int, default=6379)
+    args = parser.parse_args()
+
+    empty = interpreter_time('pass', args.count)
+    for module in ('zerg.common', 'zerg.master', 'zerg.slave'):
+        print('import {:<12}: {:.1f} ms'.format(module, (interpreter_time('import ' + module, args.count) - empty) * 1e3))
+
+    if args.redis_ip:
+        start_echo_slave(args.redis_ip, args.redis_port)
+        for bundle in (False, True):
+            with tempfile.TemporaryDirectory() as directory:
+                hosts, server = serve_config(directory, args.redis_ip, args.redis_port, bundle)
+                samples = [first_request(hosts, os.path.join(directory, 'master.sock')) for _ in range(args.count)]
+                server.shutdown()
+            print('first request ({}): {:.1f} ms'.format('bundle' if bundle else 'separate files',
+                                                         statistics.median(samples) * 1e3))
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+AdmissionController decisions and latency estimate, driven by a fake clock.
+
+    PYTHONPATH=. python -m unittest discover -s test -p 'test_*.py'
+"""
+import unittest
+import unittest.mock
+
+import zerg.master
+
+ENDPOINT = 'uhv:test'
+DEADLINE = 1.
+
+
+class FakeClock:
+    def __init__(self, now: float = 1000.):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class AdmissionTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = unittest.mock.patch.object(zerg.master, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def controller(self, **kwargs):
+        kwargs.setdefault('report_interval', 0)
+        return zerg.master.AdmissionController(**kwargs)
+
+    def serve(self, controller, latency: float, timeout: bool = False):
+        """ One admitted request taking latency seconds on the fake clock. """
+        received = self.clock.now
+        self.assertTrue(controller.admit(ENDPOINT, DEADLINE, received))
+        self.clock.now += latency
+        controller.done(ENDPOINT, self.clock.now - received, timeout, DEADLINE)
+
+    def load(self, controller):
+        return controller.stats()[ENDPOINT]
+
+
+class LatencyEstimateTest(AdmissionTest):
+    def test_ewma(self):
+        controller = self.controller(policy='deadline', latency_alpha=0.5)
+        self.serve(controller, 0.2)
+        self.assertAlmostEqual(controller.expected_latency(ENDPOINT), 0.1)
+        self.serve(controller, 0.2)
+        self.assertAlmostEqual(controller.expected_latency(ENDPOINT), 0.15)
+
+    def test_timeout_counts_as_deadline(self):
+        controller = self.controller(policy='deadline', latency_alpha=0.5)
+        self.serve(controller, 0.3, timeout=True)
+        self.assertAlmostEqual(controller.expected_latency(ENDPOINT), DEADLINE / 2)
+        self.assertEqual(self.load(controller)['timeouts'], 1)
+
+    def test_idle_time_not_accounted(self):
+        # Time between requests must not move the estimate, only finished requests do
+        controller = self.controller(policy='deadline', latency_alpha=0.5)
+        self.serve(controller, 0.01)
+        estimate = controller.expected_latency(ENDPOINT)
+        self.clock.now += 60
+        self.assertTrue(controller.admit(ENDPOINT, DEADLINE))
+        self.assertEqual(controller.expected_latency(ENDPOINT), estimate)
+
+    def test_expected_latency_only_with_deadline_policy(self):
+        controller = self.controller(policy='in_flight', latency_alpha=0.5)
+        self.serve(controller, 0.2)
+        self.assertEqual(controller.expected_latency(ENDPOINT), 0.)
+        self.assertAlmostEqual(self.load(controller)['latency'], 0.1)
+
+
+class InFlightTest(AdmissionTest):
+    def test_shed_over_max_in_flight(self):
+        controller = self.controller(policy='in_flight', max_in_flight=2)
+        self.assertTrue(controller.admit(ENDPOINT, DEADLINE))
+        self.assertTrue(controller.admit(ENDPOINT, DEADLINE))
+        self.assertFalse(controller.admit(ENDPOINT, DEADLINE))
+        self.assertTrue(controller.admit('uhv:other', DEADLINE))
+
+        controller.done(ENDPOINT, 0.01, False, DEADLINE)
+        self.assertTrue(controller.admit(ENDPOINT, DEADLINE))
+        self.assertEqual(self.load(controller)['shed'], 1)
+
+    def test_abandon(self):
+        controller = self.controller(policy='in_flight', max_in_flight=1)
+        self.assertTrue(controller.admit(ENDPOINT, DEADLINE))
+        controller.abandon(ENDPOINT)
+        load = self.load(controller)
+        self.assertEqual((load['in_flight'], load['shed'], load['latency']), (0, 1, 0.))
+        self.assertTrue(controller.admit(ENDPOINT, DEADLINE))
+
+    def test_none_never_sheds(self):
+        controller = self.controller(policy='none', max_in_flight=1)
+        for _ in range(5):
+            self.assertTrue(controller.admit(ENDPOINT, DEADLINE))
+        self.assertEqual(self.load(controller)['in_flight'], 5)
+
+
+class DeadlineTest(AdmissionTest):
+    def slow_controller(self):
+        """ Estimate at 0.9s, above shed_ratio of the deadline. """
+        controller = self.controller(policy='deadline', latency_alpha=1., shed_ratio=0.8, probe_interval=1.)
+        self.serve(controller, 0.9)
+        return controller
+
+    def test_shed_and_probe(self):
+        controller = self.slow_controller()
+        # The first request after probe_interval goes through as a probe, the next ones are shed
+        self.assertTrue(controller.admit(ENDPOINT, DEADLINE))
+        self.assertFalse(controller.admit(ENDPOINT, DEADLINE))
+        self.clock.now += 0.5
+        self.assertFalse(controller.admit(ENDPOINT, DEADLINE))
+        self.clock.now += 0.5
+        self.assertTrue(controller.admit(ENDPOINT, DEADLINE))
+        self.assertEqual(self.load(controller)['shed'], 2)
+
+    def test_recovery(self):
+        controller = self.slow_controller()
+        self.serve(controller, 0.01)
+        self.assertTrue(controller.admit(ENDPOINT, DEADLINE))
+        self.assertTrue(controller.admit(ENDPOINT, DEADLINE))
+
+    def test_remaining_deadline(self):
+        controller = self.controller(policy='deadline', latency_alpha=1., shed_ratio=0.8, probe_interval=10.)
+        self.serve(controller, 0.5)
+        self.assertTrue(controller.admit(ENDPOINT, DEADLINE, received=self.clock.now))
+        # Received 0.4s ago, 0.6s left: 0.5 > 0.8 * 0.6, only the probe goes through
+        self.assertTrue(controller.admit(ENDPOINT, DEADLINE, received=self.clock.now - 0.4))
+        self.assertFalse(controller.admit(ENDPOINT, DEADLINE, received=self.clock.now - 0.4))
+        self.assertTrue(controller.admit(ENDPOINT, DEADLINE, received=self.clock.now))
+
+
+if __name__ == '__main__':
+    unittest.main()
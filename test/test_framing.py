@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Frame completion strategies, fed byte by byte, and SerialSlave reading them over a pty.
+
+    PYTHONPATH=. python -m unittest discover -s test -p 'test_*.py'
+"""
+import binascii
+import os
+import threading
+import time
+import tty
+import unittest
+
+import zerg.framing
+import zerg.slave
+
+
+def crc16_modbus(data: bytes):
+    crc = 0xFFFF
+    for b in data:
+        crc ^= b
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return crc.to_bytes(2, 'little')
+
+
+def modbus_frame(data: bytes):
+    return data + crc16_modbus(data)
+
+
+def complete_at(frame: zerg.framing.Frame, data: bytes):
+    """ Feed one byte at a time, return the length at which the frame completed, None if it did not. """
+    frame.reset()
+    buffer = bytearray()
+    for b in data:
+        buffer.append(b)
+        if frame.feed(buffer, bytes([b])):
+            return len(buffer)
+    return None
+
+
+class TerminatorFrameTest(unittest.TestCase):
+    def test_complete_on_terminator(self):
+        frame = zerg.framing.get_frame(None, terminator=b'\r\n')
+        self.assertEqual(complete_at(frame, b'abc\r\ndef'), 5)
+
+    def test_no_terminator(self):
+        frame = zerg.framing.get_frame(None, terminator=None)
+        self.assertIsNone(complete_at(frame, b'abc\r\n'))
+
+    def test_config_terminator_overrides_default(self):
+        frame = zerg.framing.get_frame({'type': 'terminator', 'terminator': '\n'}, terminator=b'\r\n')
+        self.assertEqual(complete_at(frame, b'ab\ncd\r\n'), 3)
+
+
+class FixedLengthFrameTest(unittest.TestCase):
+    def test_complete_on_last_byte(self):
+        frame = zerg.framing.get_frame({'type': 'fixed', 'length': 7})
+        self.assertEqual(complete_at(frame, b'0123456789'), 7)
+
+    def test_remaining(self):
+        frame = zerg.framing.get_frame({'type': 'fixed', 'length': 7})
+        self.assertEqual(frame.remaining(bytearray()), 7)
+        self.assertEqual(frame.remaining(bytearray(b'0123')), 3)
+
+
+class LengthPrefixedFrameTest(unittest.TestCase):
+    def test_length_in_header(self):
+        # address, function, byte count, 4 data bytes, 2 bytes CRC
+        frame = zerg.framing.get_frame({'type': 'length', 'offset': 2, 'size': 1, 'adjust': 2})
+        self.assertEqual(complete_at(frame, modbus_frame(b'\x01\x03\x04\x00\x0a\x00\x0b') + b'xx'), 9)
+
+    def test_little_endian_and_reset(self):
+        frame = zerg.framing.get_frame({'type': 'length', 'size': 2, 'byteorder': 'little'})
+        self.assertEqual(complete_at(frame, b'\x03\x00abcdef'), 5)
+        self.assertEqual(complete_at(frame, b'\x01\x00abcdef'), 3)
+
+    def test_remaining(self):
+        frame = zerg.framing.get_frame({'type': 'length', 'offset': 2, 'size': 1, 'adjust': 2})
+        buffer = bytearray(b'\x01\x03')
+        self.assertEqual(frame.remaining(buffer), 1)
+        buffer.append(4)
+        frame.feed(buffer, b'\x04')
+        self.assertEqual(frame.remaining(buffer), 6)
+
+
+class CrcFrameTest(unittest.TestCase):
+    def test_modbus_complete_on_last_byte(self):
+        reply = modbus_frame(b'\x01\x03\x04\x00\x0a\x00\x0b')
+        frame = zerg.framing.get_frame({'type': 'crc', 'crc': 'modbus', 'min_length': 5})
+        self.assertEqual(complete_at(frame, reply + b'\x00\x00'), len(reply))
+
+    def test_min_length(self):
+        # A valid CRC is already reached after 4 bytes, min_length must hold the completion back
+        reply = modbus_frame(modbus_frame(b'\x01\x03') + b'\x55')
+        frame = zerg.framing.get_frame({'type': 'crc', 'crc': 'modbus', 'min_length': 5})
+        self.assertEqual(complete_at(frame, reply), len(reply))
+        frame = zerg.framing.get_frame({'type': 'crc', 'crc': 'modbus', 'min_length': 4})
+        self.assertEqual(complete_at(frame, reply), 4)
+
+    def test_invalid_crc(self):
+        reply = bytearray(modbus_frame(b'\x01\x03\x04\x00\x0a\x00\x0b'))
+        reply[-1] ^= 0xFF
+        frame = zerg.framing.get_frame({'type': 'crc', 'crc': 'modbus'})
+        self.assertIsNone(complete_at(frame, bytes(reply)))
+
+    def test_xmodem(self):
+        data = b'123456789'
+        reply = data + binascii.crc_hqx(data, 0).to_bytes(2, 'big')
+        frame = zerg.framing.get_frame({'type': 'crc', 'crc': 'xmodem'})
+        self.assertEqual(complete_at(frame, reply), len(reply))
+
+
+class InterByteGapFrameTest(unittest.TestCase):
+    def test_gap(self):
+        self.assertAlmostEqual(zerg.framing.get_frame({'type': 'gap'}, baudrate=9600).gap, 3.5 * 11 / 9600)
+        self.assertAlmostEqual(zerg.framing.get_frame({'type': 'gap'}, baudrate=115200).gap, 0.00175)
+        self.assertAlmostEqual(zerg.framing.get_frame({'type': 'gap', 'gap': 20}, baudrate=115200).gap, 0.020)
+
+    def test_never_complete_on_data(self):
+        frame = zerg.framing.get_frame({'type': 'gap'}, baudrate=9600)
+        self.assertIsNone(complete_at(frame, b'\x01\x03\x04'))
+
+
+class InvalidConfigTest(unittest.TestCase):
+    def assertTerminator(self, config):
+        frame = zerg.framing.get_frame(config, terminator=b'\n')
+        self.assertIsInstance(frame, zerg.framing.TerminatorFrame)
+        self.assertEqual(frame.terminator, b'\n')
+
+    def test_unknown_type(self):
+        self.assertTerminator({'type': 'bogus'})
+
+    def test_missing_argument(self):
+        self.assertTerminator({'type': 'fixed'})
+
+    def test_unknown_argument(self):
+        self.assertTerminator({'type': 'length', 'bogus': 1})
+
+    def test_unknown_crc(self):
+        self.assertTerminator({'type': 'crc', 'crc': 'crc32'})
+
+
+class DummyRedisManager:
+    def __init__(self):
+        self.slave_priority = None
+        self.monitor = type('Monitor', (), {})()
+        self.stats = type('Stats', (), {})()
+
+
+class SerialSlaveFramingTest(unittest.TestCase):
+    """ The device answers every request with REPLY followed by JUNK after a pause longer than the gap. """
+
+    REPLY = modbus_frame(b'\x01\x03\x04\x00\x0a\x00\x0b')
+    JUNK = b'\xff\xff'
+    READ_TIMEOUT = 500
+
+    def setUp(self):
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.master_fd)
+        threading.Thread(target=self.device, daemon=True).start()
+        self.slave = zerg.slave.SerialSlave(DummyRedisManager(), client_id='test', priority='high',
+                                            serial_device=os.ttyname(self.slave_fd), serial_baudrate=115200)
+        self.slave.connect(retry=False)
+
+    def tearDown(self):
+        self.slave.ser.close()
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
+
+    def device(self):
+        while True:
+            try:
+                os.read(self.master_fd, 256)
+                os.write(self.master_fd, self.REPLY)
+                time.sleep(0.05)
+                os.write(self.master_fd, self.JUNK)
+            except OSError:
+                return
+
+    def transaction(self, frame: dict):
+        tini = time.time()
+        reply = self.slave.downstream_action(b'\x01\x03', {'Frame': frame, 'ReadTimeout': self.READ_TIMEOUT})
+        return reply, time.time() - tini
+
+    def test_complete_without_read_timeout(self):
+        for frame in ({'type': 'crc', 'crc': 'modbus', 'min_length': 5},
+                      {'type': 'fixed', 'length': len(self.REPLY)},
+                      {'type': 'length', 'offset': 2, 'size': 1, 'adjust': 2},
+                      {'type': 'gap'}):
+            with self.subTest(frame=frame):
+                reply, elapsed = self.transaction(frame)
+                self.assertEqual(reply, self.REPLY)
+                self.assertLess(elapsed, 0.04)
+                # Let the junk of this transaction arrive, the next one must flush it
+                time.sleep(0.07)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
-import pkg_resources
+import os
 
 
 def get_pkg_abs_path(relative):
-    return pkg_resources.resource_filename(__name__, relative)
+    # The package is installed unzipped (zip_safe=False), pkg_resources alone costs more than 100ms to import
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), relative)
 
 
 with open(get_pkg_abs_path('VERSION'), 'r') as _f:
@@ -1,16 +1,19 @@
 #!/usr/bin/env python3
-import ast
+import functools
+import ipaddress
 import logging
+import os
 import redis
+import signal
 import time
 import types
-import requests
-import netifaces
-import ipaddress
 import threading
 
+import zerg.monitor
+import zerg.stats
+
 COMM_TYPE = b'SERIAL'
-HOSTS = ['10.0.6.61']
+HOSTS = os.environ.get('ZERG_CONFIG_HOSTS', '10.0.6.61').split(',')
 # HOSTS = [
 #     '10.0.38.42', '10.0.38.46', '10.0.38.59',
 #     '10.128.255.5', '10.128.255.4', '10.128.255.3'
@@ -19,6 +22,10 @@ LOCATION = '/cons-config'
 BEAGLE = '/beagle.json'
 MASTER = '/master.json'
 APPLICATION = '/app.json'
+# beagle.json, master.json and app.json in a single file, built by 'make bundle'
+BUNDLE = '/bundle.json'
+BUNDLE_KEYS = {BEAGLE: 'beagle', MASTER: 'master', APPLICATION: 'app'}
+CONFIG_TIMEOUT = 5
 
 HIGH = 'high'
 LOW = 'low'
@@ -39,6 +46,15 @@ def log_config(level: int = logging.INFO):
 logger = logging.getLogger()
 
 
+def exit_on_sigterm():
+    """ Raise SystemExit on SIGTERM, so a stopped service runs its finally clauses, e.g. the last statistics flush. """
+
+    def terminate(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+
+
 class BeagleConfig:
     def __init__(self, config: dict, ip: str):
         self.ip = ip
@@ -57,41 +73,71 @@ class StreamConfig:
         self.terminator = config['terminator']
         self.read_payload_length = config['read_payload_length']
 
+    def socket_settings(self):
+        """ Socket keyword arguments of the stream masters. """
+        return {
+            'socket_read_payload_length': self.read_payload_length,
+            'socket_reconnect_interval': self.reconnect_interval,
+            'socket_terminator': get_terminator_bytes(self.terminator),
+            'socket_timeout': self.timeout,
+            'socket_buffer': self.buffer,
+            'socket_trim_terminator': self.trim_terminator,
+        }
 
-def get_device_settings():
-    url = None
-    for host in HOSTS:
-        try:
-            url = 'http://{}{}{}'.format(host, LOCATION, BEAGLE)
-            return requests.get(url=url, verify=False).json()
-        except requests.exceptions.ConnectionError:
-            logger.warning('Unable to get response from {}'.format(url))
 
-    return None
+def fetch_config(name: str, optional: bool = False):
+    """
+    Download a config file from the first host that answers.
 
+    :param optional: The file may not be published, a 404 is not worth a warning.
+    """
+    # requests is only needed at startup, do not pay for its import on module load
+    import requests
 
-def get_config_settings():
     url = None
     for host in HOSTS:
         try:
-            url = 'http://{}{}{}'.format(host, LOCATION, APPLICATION)
-            return requests.get(url=url, verify=False).json()
-        except requests.exceptions.ConnectionError:
+            url = 'http://{}{}{}'.format(host, LOCATION, name)
+            response = requests.get(url=url, verify=False, timeout=CONFIG_TIMEOUT)
+            if response.status_code == 200:
+                return response.json()
+            if optional and response.status_code == 404:
+                logger.debug('{} not published.'.format(url))
+                continue
+            logger.warning('Unable to get {}: HTTP {}'.format(url, response.status_code))
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
             logger.warning('Unable to get response from {}'.format(url))
+        except ValueError:
+            logger.warning('Invalid json from {}'.format(url))
 
     return None
 
 
-def get_master_settings():
-    url = None
-    for host in HOSTS:
-        try:
-            url = 'http://{}{}{}'.format(host, LOCATION, MASTER)
-            return requests.get(url=url, verify=False).json()
-        except requests.exceptions.ConnectionError:
-            logger.warning('Unable to get response from {}'.format(url))
+@functools.lru_cache(maxsize=None)
+def get_config_bundle():
+    """ All config files in one download, None if the bundle is not published. Fetched once per process. """
+    return fetch_config(BUNDLE, optional=True)
 
-    return None
+
+@functools.lru_cache(maxsize=None)
+def get_config(name: str):
+    """ A config file, from the bundle when available. Fetched once per process. """
+    bundle = get_config_bundle()
+    if bundle and BUNDLE_KEYS[name] in bundle:
+        return bundle[BUNDLE_KEYS[name]]
+    return fetch_config(name)
+
+
+def get_device_settings():
+    return get_config(BEAGLE)
+
+
+def get_config_settings():
+    return get_config(APPLICATION)
+
+
+def get_master_settings():
+    return get_config(MASTER)
 
 
 def get_master_data(type: str, endpoint: str):
@@ -99,17 +145,6 @@ def get_master_data(type: str, endpoint: str):
     return data[type][endpoint]
 
 
-def get_interfaces_data():
-    """ Get all interface settings """
-    data = []
-    for iface in netifaces.interfaces():
-        addresses = netifaces.ifaddresses(iface)
-        for v in addresses.values():
-            for d in v:
-                data.append(d)
-    return data
-
-
 def get_beagle_config():
     """ Get a single config related to this ip list """
     ips = get_valid_ips()
@@ -127,21 +162,25 @@ def get_application_config(app: str):
     return get_config_settings()[app]
 
 
+@functools.lru_cache(maxsize=None)
 def get_valid_ips():
-    """ Find valid ips """
+    """ Find valid ips, only IPv4 addresses are inspected. Resolved once per process. """
+    import netifaces
+
     ips = []
-    for v in get_interfaces_data():
-        if 'netmask' in v:
-            try:
-                ipv4 = ipaddress.IPv4Address(v['addr'])
-                for net in VALID_NETWORKS:
-                    if ipv4 in net:
-                        ips.append(str(ipv4))
-                        logger.info('Valid interface {}'.format(v))
-                        break
-            except:
-                logger.debug('Invalid interface {}'.format(v))
-    return ips
+    for iface in netifaces.interfaces():
+        for v in netifaces.ifaddresses(iface).get(netifaces.AF_INET, []):
+            if 'netmask' in v:
+                try:
+                    ipv4 = ipaddress.IPv4Address(v['addr'])
+                    for net in VALID_NETWORKS:
+                        if ipv4 in net:
+                            ips.append(str(ipv4))
+                            logger.info('Valid interface {}'.format(v))
+                            break
+                except:
+                    logger.debug('Invalid interface {}'.format(v))
+    return tuple(ips)
 
 
 def get_log_level(level: str):
@@ -209,7 +248,14 @@ class RedisManager:
 
     def __init__(self, stream_name, ip='localhost', port=6379, db=0, tick: float = 0.001, upstream_timeout: float = 1,
                  reconnect_interval: float = 30,
-                 slave_priority: str = HIGH):
+                 slave_priority: str = HIGH,
+                 claim_lease: float = 2.,
+                 monitor_sample_rate: float = 1.,
+                 monitor_max_payload: int = 256,
+                 monitor_probe_interval: float = 1.,
+                 stats_bucket: int = 60,
+                 stats_retention: int = 1440,
+                 stats_flush_interval: float = 5.):
 
         RedisManager.init_pool(ip, port, db)
 
@@ -218,11 +264,17 @@ class RedisManager:
         self.connect()
 
         self.slave_priority = slave_priority
+        self.slave_client_id = str(os.getpid())
 
+        self.stream_name = stream_name
         self.downstream_data = stream_name + '#down#data'
         self.upstream_data = stream_name + '#up#data'
         self.upstream_listen = stream_name + '#up#listen'
         self.slave_status = stream_name + '#slave'
+        # Owner of the request being executed, '<message_id>|<slave_client_id>' with a short lease
+        self.slave_claim = stream_name + '#claim'
+        # Slave claim counters: claimed, claim_lost, replied, late and wasted executions, per slave_client_id
+        self.slave_claim_stats = stream_name + '#claim#stats'
 
         # This is a redis hash containing special settings for comm
         self.device_comm_settings = stream_name + '#device#comm#settings'
@@ -231,15 +283,37 @@ class RedisManager:
         self._pipeline = self.connection.pipeline(transaction=True)
         self._tick = tick
         self._reconnect_interval = reconnect_interval
+        self._claim_lease = int(claim_lease * 1000)
 
         self._upstream_listen_code = None
 
+        # Last device_comm_settings received by the slave, parsed only when it changes
+        self._device_comm_settings_raw = None
+        self._device_comm_settings = {}
+
+        # Read-only request/reply summaries, published only while someone is subscribed
+        self.monitor = zerg.monitor.MonitorTap(self.connection, stream_name,
+                                               sample_rate=monitor_sample_rate,
+                                               max_payload=monitor_max_payload,
+                                               probe_interval=monitor_probe_interval)
+
+        # Per-endpoint statistics in time buckets, written in batches by a daemon thread. stats.close() on exit.
+        self.stats = zerg.stats.StatsRecorder(self.connection, stream_name,
+                                              bucket=stats_bucket,
+                                              retention=stats_retention,
+                                              flush_interval=stats_flush_interval)
+        self.stats.start()
+
         if upstream_timeout <= 0.:
             logger.error('Redis upstream timeout must be greater than zero. Using default value of 2.')
             self._upstream_timeout = 2.
         else:
             self._upstream_timeout = upstream_timeout
 
+    @property
+    def upstream_timeout(self):
+        return self._upstream_timeout
+
     def slave_alive_signal_start(self):
         self.slave_alive_thread.start()
 
@@ -275,13 +349,32 @@ class RedisManager:
                 
             ''', 5, self.slave_status, self.slave_priority, HIGH, LOW, EXPIRE_TIMER)
 
+    @classmethod
+    def from_config(cls, redis_config: dict, app_config: dict, stream_name: str):
+        """
+        :param redis_config: 'the-overmind' application config.
+        :param app_config: Config of the application served, e.g. 'uhv'.
+        :param stream_name: Endpoint name.
+        """
+        return cls(
+            ip=redis_config['ip'], port=redis_config['port'], db=redis_config['db'],
+            monitor_sample_rate=redis_config['monitor']['sample_rate'],
+            monitor_max_payload=redis_config['monitor']['max_payload'],
+            monitor_probe_interval=redis_config['monitor']['probe_interval'],
+            stats_bucket=redis_config['stats']['bucket'],
+            stats_retention=redis_config['stats']['retention'],
+            stats_flush_interval=redis_config['stats']['flush_interval'],
+            upstream_timeout=app_config['redis']['upstream_timeout'],
+            claim_lease=app_config['redis']['claim_lease'],
+            stream_name=stream_name)
+
     @staticmethod
     def init_pool(ip: str = 'localhost', port: int = 6379, db: int = 0):
         if not RedisManager._pool:
             RedisManager._pool = redis.ConnectionPool(host=ip, port=port, db=db)
             logger.info('Redis pool: {}:{} db={}'.format(ip, port, db))
         else:
-            logger.warning('Redis pool already exists.')
+            logger.debug('Redis pool already exists.')
 
     def connect(self):
         if RedisManager._pool:
@@ -303,7 +396,8 @@ class RedisManager:
         try:
             self.master_downstream_handler(data, settings)
             self.master_pool_data()
-            return self.master_upstream_handler()
+            upstream_data = self.master_upstream_handler()
+            return upstream_data
         except redis.exceptions.ConnectionError:
             logger.fatal('Redis connection lost to {}.'.format(RedisManager._pool.__str__()))
             return None
@@ -352,6 +446,26 @@ class RedisManager:
                                                                                         self._reconnect_interval))
                 time.sleep(self._reconnect_interval)
 
+    def parse_device_comm_settings(self, raw: bytes):
+        """
+        Parse the device_comm_settings value. The master sets it on every request but it rarely changes, so the last
+        parsed dictionary is reused while the raw value is the same. The same dict instance is returned in that case.
+        """
+        if raw == self._device_comm_settings_raw:
+            return self._device_comm_settings
+
+        import ast
+
+        try:
+            settings = ast.literal_eval(raw.decode('utf-8'))
+        except:
+            settings = {}
+            logger.warning("Impossible to parse device_comm_settings {}.".format(raw))
+
+        self._device_comm_settings_raw = raw
+        self._device_comm_settings = settings
+        return settings
+
     def slave_downstream_handler(self, _message_id):
 
         message_id = _message_id['data']
@@ -361,6 +475,10 @@ class RedisManager:
             -- KEYS[3] self.message_id
             -- KEYS[4] self.slave_status
             -- KEYS[5] self.slave_priority
+            -- KEYS[6] self.slave_claim
+            -- KEYS[7] self.slave_client_id
+            -- KEYS[8] self._claim_lease
+            -- KEYS[9] self.slave_claim_stats
             
             if redis.call('exists', KEYS[2]) == 0 then
                return nil
@@ -373,22 +491,29 @@ class RedisManager:
                 return nil
             end
             
-            -- If there's no response from downstream and this request is still valid
-            if redis.call('get',  KEYS[1]) == KEYS[3] then
-                return redis.call('get', KEYS[2])
+            -- The request is no longer valid
+            if redis.call('get',  KEYS[1]) ~= KEYS[3] then
+                return nil
             end
 
-            return nil
-            ''', 5, self.upstream_listen, self.downstream_data, message_id,
-                            self.slave_status, self.slave_priority)
+            -- Claim the request before executing it, so a single slave touches the bus even if both see it
+            local claim = redis.call('get', KEYS[6])
+            local owner = KEYS[3] .. '|' .. KEYS[7]
+            if claim and claim ~= owner and string.sub(claim, 1, string.len(KEYS[3]) + 1) == KEYS[3] .. '|' then
+                redis.call('hincrby', KEYS[9], KEYS[7] .. ':claim_lost', 1)
+                return nil
+            end
+            redis.call('set', KEYS[6], owner, 'PX', tonumber(KEYS[8]))
+            redis.call('hincrby', KEYS[9], KEYS[7] .. ':claimed', 1)
+
+            return redis.call('get', KEYS[2])
+            ''', 9, self.upstream_listen, self.downstream_data, message_id,
+                            self.slave_status, self.slave_priority,
+                            self.slave_claim, self.slave_client_id, self._claim_lease, self.slave_claim_stats)
         self._pipeline.get(self.device_comm_settings)
         response = self._pipeline.execute()
         downstream_data = response[0]
-        try:
-            settings = ast.literal_eval(response[1].decode('utf-8'))
-        except:
-            settings = {}
-            logger.warning("Impossible to parse device_comm_settings {}.".format(response[1]))
+        settings = self.parse_device_comm_settings(response[1])
 
         if not downstream_data:
             logger.debug('Timeout {}: {}'.format(self.upstream_listen, message_id))
@@ -396,7 +521,9 @@ class RedisManager:
 
         logger.debug('{}: {}'.format(self.downstream_data, downstream_data))
 
+        tini = time.time()
         os_data = self._downstream_action(downstream_data, settings)
+        latency = time.time() - tini
 
         if os_data:
             res = self.connection.eval(
@@ -405,22 +532,40 @@ class RedisManager:
                 -- KEYS[2] os_data
                 -- KEYS[3] self.redis_upstream_listen
                 -- KEYS[4] message_id
+                -- KEYS[5] self.slave_claim_stats
+                -- KEYS[6] self.slave_client_id
 
                 local valid_id = redis.call('get', KEYS[3]) == KEYS[4]
 
                 -- If the message is deprecated exit
                 if not valid_id then
+                   redis.call('hincrby', KEYS[5], KEYS[6] .. ':late', 1)
                    return -1
                 end
                 
-                -- If there is another answer exit
+                -- If there is another answer exit, the device was accessed twice
                 if redis.call('exists', KEYS[1]) == 1 then
+                    redis.call('hincrby', KEYS[5], KEYS[6] .. ':wasted', 1)
                     return -2
                 end
 
                 -- Answer the request
                 redis.call('set', KEYS[1], KEYS[2])
+                redis.call('hincrby', KEYS[5], KEYS[6] .. ':replied', 1)
                 return 1
-                ''', 4, self.upstream_data, os_data, self.upstream_listen, message_id)
+                ''', 6, self.upstream_data, os_data, self.upstream_listen, message_id,
+                self.slave_claim_stats, self.slave_client_id)
+
+            if res == -2:
+                logger.warning('{}: wasted execution, request {} already answered.'.format(
+                    self.upstream_data, message_id))
 
             logger.debug('{}: {} status={}'.format(self.upstream_data, os_data, res))
+
+        # After the reply, the master is polling for it
+        self.report(downstream_data, os_data, latency)
+
+    def report(self, request: bytes, reply: bytes, latency: float):
+        """ Publish a transaction to the monitor and record its statistics. Call it once the reply is on its way. """
+        self.monitor.publish(request, reply, latency)
+        self.stats.record(latency, len(request), len(reply) if reply else 0, not reply)
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+import logging
+
+logger = logging.getLogger()
+
+TERMINATOR = 'terminator'
+FIXED = 'fixed'
+LENGTH = 'length'
+CRC = 'crc'
+GAP = 'gap'
+
+
+class Frame:
+    """
+    Frame completion strategy of a serial reply.
+
+    A frame is fed with the data read so far and decides, on the last byte received, whether the reply is complete.
+    Instances keep per-transaction state and are reused: reset() must be called before each transaction.
+    """
+
+    # When not None, the reply is complete after this many seconds of silence once the first byte arrived
+    gap = None
+
+    def reset(self):
+        pass
+
+    def remaining(self, buffer: bytearray):
+        """ Number of bytes that can be read at once without going past the end of the frame. """
+        return 1
+
+    def feed(self, buffer: bytearray, data: bytes):
+        """
+        :param buffer: Everything received so far, data included.
+        :param data: The bytes just received.
+        :return: True if the frame is complete.
+        """
+        return False
+
+
+class TerminatorFrame(Frame):
+    """ Complete when the reply ends with the terminator. Without a terminator only MaxInput or timeouts apply. """
+
+    def __init__(self, terminator: bytes = None):
+        self.terminator = terminator
+
+    def feed(self, buffer: bytearray, data: bytes):
+        return bool(self.terminator) and buffer.endswith(self.terminator)
+
+    def __str__(self):
+        return 'TerminatorFrame({})'.format(self.terminator)
+
+
+class FixedLengthFrame(Frame):
+    """ Complete after a fixed number of bytes. """
+
+    def __init__(self, length: int):
+        self.length = length
+
+    def remaining(self, buffer: bytearray):
+        return max(self.length - len(buffer), 1)
+
+    def feed(self, buffer: bytearray, data: bytes):
+        return len(buffer) >= self.length
+
+    def __str__(self):
+        return 'FixedLengthFrame({})'.format(self.length)
+
+
+class LengthPrefixedFrame(Frame):
+    """
+    Complete when the length announced in the header has been received.
+    Frame length = offset + size + <length field value> + adjust.
+    """
+
+    def __init__(self, offset: int = 0, size: int = 1, byteorder: str = 'big', adjust: int = 0):
+        """
+        :param offset: Position of the length field.
+        :param size: Size of the length field in bytes.
+        :param byteorder: 'big' or 'little'.
+        :param adjust: Bytes not accounted for by the length field, e.g. a trailing checksum. May be negative.
+        """
+        self.offset = offset
+        self.size = size
+        self.byteorder = byteorder
+        self.adjust = adjust
+        self._header = offset + size
+        self._length = None
+
+    def reset(self):
+        self._length = None
+
+    def remaining(self, buffer: bytearray):
+        if self._length is None:
+            return max(self._header - len(buffer), 1)
+        return max(self._length - len(buffer), 1)
+
+    def feed(self, buffer: bytearray, data: bytes):
+        if self._length is None:
+            if len(buffer) < self._header:
+                return False
+            self._length = self._header + self.adjust + \
+                int.from_bytes(buffer[self.offset:self._header], self.byteorder)
+        return len(buffer) >= self._length
+
+    def __str__(self):
+        return 'LengthPrefixedFrame(offset={}, size={}, byteorder={}, adjust={})'.format(
+            self.offset, self.size, self.byteorder, self.adjust)
+
+
+def _crc16_modbus_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+def _crc16_xmodem_table():
+    table = []
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1) & 0xFFFF
+        table.append(crc)
+    return table
+
+
+_CRC16_MODBUS = _crc16_modbus_table()
+_CRC16_XMODEM = _crc16_xmodem_table()
+
+
+class CrcFrame(Frame):
+    """
+    Complete when the frame carries a valid trailing CRC-16. The CRC is updated on each byte and, for both supported
+    algorithms, the CRC of a frame including its own checksum is zero, so no trailing timeout is required.
+
+    'modbus': CRC-16/MODBUS, appended low byte first.
+    'xmodem': CRC-16/XMODEM (CCITT), appended high byte first.
+    """
+
+    def __init__(self, crc: str = 'modbus', min_length: int = 4):
+        """
+        :param crc: 'modbus' or 'xmodem'.
+        :param min_length: Shortest valid frame, checksum included. Guards against an early match on the header.
+        """
+        if crc not in ('modbus', 'xmodem'):
+            raise ValueError('Unknown CRC {}'.format(crc))
+        self.crc = crc
+        self.min_length = min_length
+        self._init = 0xFFFF if crc == 'modbus' else 0x0000
+        self._value = self._init
+
+    def reset(self):
+        self._value = self._init
+
+    def feed(self, buffer: bytearray, data: bytes):
+        value = self._value
+        if self.crc == 'modbus':
+            for b in data:
+                value = (value >> 8) ^ _CRC16_MODBUS[(value ^ b) & 0xFF]
+        else:
+            for b in data:
+                value = ((value << 8) & 0xFFFF) ^ _CRC16_XMODEM[(value >> 8) ^ b]
+        self._value = value
+        return value == 0 and len(buffer) >= self.min_length
+
+    def __str__(self):
+        return 'CrcFrame({}, min_length={})'.format(self.crc, self.min_length)
+
+
+class InterByteGapFrame(Frame):
+    """
+    Complete after a silence on the line, Modbus RTU style. The default gap is 3.5 characters of 11 bits at the port
+    baud rate, with the fixed 1.75ms recommended by the Modbus specification above 19200 bps.
+
+    USB-serial adapters deliver the received bytes in chunks, FTDI ones every 16ms by default (latency timer). Such a
+    gap splits frames: lower the latency timer (/sys/bus/usb-serial/devices/ttyUSB*/latency_timer) or set an explicit
+    gap above it, e.g. {'type': 'gap', 'gap': 20}.
+    """
+
+    def __init__(self, baudrate: int, chars: float = 3.5, gap: float = None):
+        """
+        :param baudrate: Port baud rate.
+        :param chars: Gap length in characters.
+        :param gap: Explicit gap in milliseconds, overrides chars.
+        """
+        if gap is not None:
+            self.gap = gap / 1000
+        elif baudrate > 19200:
+            self.gap = 0.00175
+        else:
+            self.gap = chars * 11 / baudrate
+
+    def __str__(self):
+        return 'InterByteGapFrame({:.6f}s)'.format(self.gap)
+
+
+def get_frame(config: dict = None, terminator: bytes = None, baudrate: int = 9600):
+    """
+    Build a frame completion strategy.
+
+    :param config: Frame description, e.g. {'type': 'fixed', 'length': 7} or {'type': 'crc', 'crc': 'modbus'}.
+                   The remaining keys are the constructor arguments of the selected strategy.
+                   When missing the terminator strategy is used.
+    :param terminator: Terminator used by the terminator strategy.
+    :param baudrate: Port baud rate, used by the inter-byte gap strategy.
+    """
+    if not config:
+        return TerminatorFrame(terminator)
+
+    kwargs = dict(config)
+    frame_type = kwargs.pop('type', TERMINATOR)
+    try:
+        if frame_type == TERMINATOR:
+            return TerminatorFrame(kwargs['terminator'].encode('utf-8') if 'terminator' in kwargs else terminator)
+        elif frame_type == FIXED:
+            return FixedLengthFrame(**kwargs)
+        elif frame_type == LENGTH:
+            return LengthPrefixedFrame(**kwargs)
+        elif frame_type == CRC:
+            return CrcFrame(**kwargs)
+        elif frame_type == GAP:
+            return InterByteGapFrame(baudrate, **kwargs)
+        else:
+            logger.error('Unknown frame type {}. Using terminator.'.format(frame_type))
+    except (TypeError, ValueError, AttributeError):
+        logger.exception('Invalid frame config {}. Using terminator.'.format(config))
+    return TerminatorFrame(terminator)
@@ -2,18 +2,236 @@
 
 import logging
 import os
+import signal
 import socket
+import threading
+import time
 
 import zerg.common
 import zerg
 
 logger = logging.getLogger()
 
+BUSY = b'BUSY'
+
+# TCP connection handshake, 'EP|<endpoint>|PE' answered by OK or ERR
+HANDSHAKE_PREFIX = b'EP|'
+HANDSHAKE_SUFFIX = b'|PE'
+HANDSHAKE_OK = b'OK'
+HANDSHAKE_ERR = b'ERR'
+
+SHED_NONE = 'none'
+SHED_IN_FLIGHT = 'in_flight'
+SHED_DEADLINE = 'deadline'
+SHED_ALL = 'all'
+
+
+class EndpointLoad:
+    """ Load figures of a single endpoint. """
+
+    def __init__(self):
+        self.in_flight = 0
+        self.latency = 0.
+        self.served = 0
+        self.shed = 0
+        self.timeouts = 0
+        self.last_probe = 0.
+
+
+class AdmissionController:
+    """
+    Admission control for the master side. Tracks in-flight requests and an exponentially weighted latency estimate
+    per endpoint and rejects requests early, instead of letting every request run into the upstream timeout.
+
+    Policies:
+        none: Never shed, only count.
+        in_flight: Shed when max_in_flight requests are already running, or queued, for the endpoint.
+        deadline: Shed when the latency estimate exceeds shed_ratio of the remaining deadline. One request per
+                  probe_interval is still let through so the estimate can recover.
+        all: in_flight and deadline.
+    """
+
+    def __init__(self, policy: str = SHED_NONE, max_in_flight: int = 1, shed_ratio: float = 0.8,
+                 latency_alpha: float = 0.3, probe_interval: float = 1., report_interval: float = 60.):
+        """
+        :param policy: Shedding policy.
+        :param max_in_flight: Concurrent requests allowed per endpoint. Over TCP the requests of an endpoint are
+                              serialized, the extra ones wait in queue, see BaseMaster.sync_send_receive.
+        :param shed_ratio: Fraction of the remaining deadline the latency estimate may use.
+        :param latency_alpha: Weight of the newest sample in the latency estimate. Timeouts count as the deadline.
+        :param probe_interval: Seconds between requests let through while shedding by deadline.
+        :param report_interval: Seconds between served/shed reports in the log, disabled if <= 0.
+        """
+        if policy not in (SHED_NONE, SHED_IN_FLIGHT, SHED_DEADLINE, SHED_ALL):
+            logger.error('Unknown shedding policy {}. Using {}.'.format(policy, SHED_NONE))
+            policy = SHED_NONE
+
+        self.policy = policy
+        self.max_in_flight = max_in_flight
+        self.shed_ratio = shed_ratio
+        self.latency_alpha = latency_alpha
+        self.probe_interval = probe_interval
+        self.report_interval = report_interval
+
+        self._loads = {}
+        self._lock = threading.Lock()
+        self._last_report = time.time()
+
+    @classmethod
+    def from_config(cls, config: dict):
+        """ :param config: 'admission' section of the application config. """
+        return cls(policy=config['policy'],
+                   max_in_flight=config['max_in_flight'],
+                   shed_ratio=config['shed_ratio'],
+                   latency_alpha=config['latency_alpha'],
+                   probe_interval=config['probe_interval'],
+                   report_interval=config['report_interval'])
+
+    def _load(self, endpoint: str):
+        load = self._loads.get(endpoint)
+        if load is None:
+            load = self._loads[endpoint] = EndpointLoad()
+        return load
+
+    def admit(self, endpoint: str, deadline: float, received: float = None):
+        """
+        Decide whether a request should be forwarded. Each admitted request must be followed by a call to done().
+
+        :param endpoint: Endpoint name.
+        :param deadline: Time the requester waits for an answer, in seconds.
+        :param received: When the request was received, defaults to now.
+        :return: True if admitted, False if the request must be answered as busy.
+        """
+        now = time.time()
+        remaining = deadline - (now - received) if received else deadline
+
+        with self._lock:
+            load = self._load(endpoint)
+
+            if self.policy in (SHED_IN_FLIGHT, SHED_ALL) and load.in_flight >= self.max_in_flight:
+                load.shed += 1
+                logger.debug('{}: shed, {} requests in flight.'.format(endpoint, load.in_flight))
+                return False
+
+            if self.policy in (SHED_DEADLINE, SHED_ALL) and load.latency > remaining * self.shed_ratio:
+                if now - load.last_probe < self.probe_interval:
+                    load.shed += 1
+                    logger.debug('{}: shed, expected latency {:.3f}s remaining deadline {:.3f}s.'.format(
+                        endpoint, load.latency, remaining))
+                    return False
+                load.last_probe = now
+
+            load.in_flight += 1
+            return True
+
+    def expected_latency(self, endpoint: str):
+        """ Latency estimate of the endpoint, zero unless the policy sheds by deadline. """
+        if self.policy not in (SHED_DEADLINE, SHED_ALL):
+            return 0.
+        with self._lock:
+            return self._load(endpoint).latency
+
+    def abandon(self, endpoint: str):
+        """ An admitted request shed before being forwarded, e.g. its deadline ran out waiting for the endpoint. """
+        with self._lock:
+            load = self._load(endpoint)
+            load.in_flight -= 1
+            load.shed += 1
+
+    def done(self, endpoint: str, latency: float, timeout: bool, deadline: float):
+        """
+        Account for a finished request.
+
+        :param endpoint: Endpoint name.
+        :param latency: Request duration in seconds.
+        :param timeout: True if no answer was received.
+        :param deadline: Time the requester waits for an answer, in seconds.
+        """
+        with self._lock:
+            load = self._load(endpoint)
+            load.in_flight -= 1
+            if timeout:
+                load.timeouts += 1
+                latency = max(latency, deadline)
+            else:
+                load.served += 1
+            load.latency += self.latency_alpha * (latency - load.latency)
+
+            now = time.time()
+            if self.report_interval > 0 and now - self._last_report >= self.report_interval:
+                self._last_report = now
+                for name, l in sorted(self._loads.items()):
+                    logger.info('{}: served={} shed={} timeouts={} in_flight={} latency={:.3f}s'.format(
+                        name, l.served, l.shed, l.timeouts, l.in_flight, l.latency))
+
+    def stats(self):
+        """ Snapshot of the per endpoint counters. """
+        with self._lock:
+            return {name: {'served': l.served, 'shed': l.shed, 'timeouts': l.timeouts,
+                           'in_flight': l.in_flight, 'latency': l.latency}
+                    for name, l in self._loads.items()}
+
+
+def supervise(workers: dict, respawn_interval: float = 1.):
+    """
+    Pre-fork supervisor. Run each worker in a child forked from this, already warmed up, interpreter and respawn the
+    children that exit. Workers must create their own redis connections, the pool must not exist before the fork.
+
+    :param workers: Name -> callable running the worker forever.
+    :param respawn_interval: Seconds to wait before respawning a worker that exited.
+    """
+    children = {}
+
+    def spawn(name):
+        pid = os.fork()
+        if pid == 0:
+            # The parent handlers act on the children list, a child must not run them. Ctrl+C reaches the whole
+            # process group, the parent forwards it to the children as SIGTERM, which lets the worker clean up.
+            zerg.common.exit_on_sigterm()
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            try:
+                workers[name]()
+            except Exception:
+                logger.exception('Worker {} failed.'.format(name))
+            finally:
+                os._exit(1)
+        children[pid] = name
+        logger.info('Worker {} started, pid {}.'.format(name, pid))
+
+    def terminate(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+
+    for name in workers:
+        spawn(name)
+
+    while True:
+        pid, status = os.wait()
+        name = children.pop(pid, None)
+        if name is None:
+            continue
+        logger.error('Worker {} pid {} exited with status {}. Respawn in {}s.'.format(
+            name, pid, status, respawn_interval))
+        time.sleep(respawn_interval)
+        spawn(name)
+
 
 class BaseMaster:
 
-    def __init__(self, redis_manager: zerg.common.RedisManager):
+    def __init__(self, redis_manager: zerg.common.RedisManager, admission: AdmissionController = None):
         self.redis_manager = redis_manager
+        self.admission = admission if admission else AdmissionController()
+        # Serializes the requests of connections sharing the endpoint, they would overwrite each other's keys
+        self.endpoint_lock = None
+        # Last forwarded request, reply and latency, reported once the reply is sent to the device
+        self._transaction = None
 
     def get_from_device(self, *args, **kwargs):
         logger.warning("Override method {} from {}".format(self.get_from_device.__name__, self.__str__()))
@@ -31,9 +249,58 @@ class BaseMaster:
                 settings = data.split(b'|')[1]
                 data = self.get_from_device()
 
-            upstream_response = self.redis_manager.master_sync_send_receive(data, settings=settings)
+            # Idle timeout or dropped partial frame, nothing was requested
+            if not data:
+                continue
+
+            upstream_response = self.sync_send_receive(data, settings=settings, received=time.time())
 
             self.send_to_device(upstream_response)
+            self.report()
+
+    def report(self):
+        """ Monitor and statistics of the last forwarded request, kept out of the reply path. """
+        if self._transaction is not None:
+            self.redis_manager.report(*self._transaction)
+            self._transaction = None
+
+    def sync_send_receive(self, data: bytes, settings: bytes = b'{}', received: float = None):
+        """
+        Forward a request upstream if admitted, BUSY otherwise.
+
+        With an endpoint_lock, admitted requests of other connections on the same endpoint queue for the lock. The
+        queued requests count as in flight, so max_in_flight - 1 is the queue length allowed per endpoint. The wait is
+        bounded by the remaining deadline minus the expected latency, the request is shed when it runs out. The wait
+        is part of the latency accounted for.
+        """
+        endpoint = self.redis_manager.stream_name
+        deadline = self.redis_manager.upstream_timeout
+        if received is None:
+            received = time.time()
+
+        if not self.admission.admit(endpoint, deadline, received):
+            self.redis_manager.stats.record_shed()
+            return BUSY
+
+        if self.endpoint_lock:
+            wait = deadline - (time.time() - received) - self.admission.expected_latency(endpoint)
+            if wait <= 0 or not self.endpoint_lock.acquire(timeout=wait):
+                logger.debug('{}: shed, deadline expired waiting for the endpoint.'.format(endpoint))
+                self.admission.abandon(endpoint)
+                self.redis_manager.stats.record_shed()
+                return BUSY
+
+        upstream_response = None
+        tini = time.time()
+        try:
+            upstream_response = self.redis_manager.master_sync_send_receive(data, settings=settings)
+        finally:
+            if self.endpoint_lock:
+                self.endpoint_lock.release()
+            now = time.time()
+            self.admission.done(endpoint, now - received, upstream_response is None, deadline)
+        self._transaction = (data, upstream_response, now - tini)
+        return upstream_response
 
 
 class STREAMSocketMaster(BaseMaster):
@@ -41,9 +308,10 @@ class STREAMSocketMaster(BaseMaster):
 
     def __init__(self, socket_path,
                  redis_manager: zerg.common.RedisManager,
+                 admission: AdmissionController = None,
                  socket_reconnect_interval: int = 30,
                  socket_terminator: bytes = None,
-                 socket_buffer: int = 1,
+                 socket_buffer: int = 4096,
                  socket_timeout: int = 5,
                  socket_read_payload_length: bool = False,
                  socket_trim_terminator: bool = True
@@ -51,13 +319,14 @@ class STREAMSocketMaster(BaseMaster):
         """
 
         :param socket_path:
+        :param admission: Admission controller, requests are never shed if None.
         :param socket_reconnect_interval:
         :param socket_terminator:
-        :param socket_buffer:
+        :param socket_buffer: Size of each recv, bytes past the current message are kept for the next one.
         :param socket_timeout:
         :param socket_read_payload_length: If enabled, the first 4 bytes are the remaining payload length.
         """
-        super().__init__(redis_manager)
+        super().__init__(redis_manager, admission)
 
         self.socket_path = socket_path
         self.socket_buffer = socket_buffer
@@ -67,6 +336,9 @@ class STREAMSocketMaster(BaseMaster):
         self.socket_timeout = socket_timeout
         self.socket_trim_terminator = socket_trim_terminator
 
+        self.conn = None
+        self._buffer = bytearray()
+
     def send_to_device(self, upstream_response):
         if upstream_response is None:
             upstream_response = b'TOUT'
@@ -75,34 +347,61 @@ class STREAMSocketMaster(BaseMaster):
             upstream_response = upstream_response.encode('utf-8')
         logger.debug('To device: {}'.format(upstream_response))
 
-        self.conn.sendall(upstream_response + self.socket_terminator)
+        self.conn.sendall(upstream_response + (self.socket_terminator or b''))
+
+    def recv(self):
+        b = self.conn.recv(self.socket_buffer)
+        if b == b'':
+            raise ConnectionResetError('Connection closed by the peer.')
+        self._buffer += b
 
     def get_from_device(self, *args, **kwargs):
+        try:
+            if self.socket_read_payload_length:
+                while len(self._buffer) < 4:
+                    self.recv()
+                end = 4 + int(self._buffer[:4])
+                while len(self._buffer) < end:
+                    self.recv()
+                data = bytes(self._buffer[4:end])
+                del self._buffer[:end]
+                return data
 
-        data = b''
-        socket_continue_recv = True
-        while socket_continue_recv:
-            try:
-                if self.socket_read_payload_length:
-                    payload_length = int(self.conn.recv(4))
-                    b = self.conn.recv(payload_length)
-                    if b == b'':
-                        break
-                    data = b
-                    socket_continue_recv = False
-                else:
-                    b = self.conn.recv(self.socket_buffer)
-                    if b == b'':
-                        break
-                    data += b
-                    if self.socket_terminator and data.endswith(self.socket_terminator):
-                        if self.socket_trim_terminator:
-                            data = data[:-len(self.socket_terminator)]
-                        socket_continue_recv = False
-            except socket.timeout:
-                socket_continue_recv = False
-                logger.debug('Socket read operation terminated via timeout, data {}.'.format(data))
-        return data
+            while True:
+                if self.socket_terminator:
+                    index = self._buffer.find(self.socket_terminator)
+                    if index >= 0:
+                        end = index + len(self.socket_terminator)
+                        data = bytes(self._buffer[:index if self.socket_trim_terminator else end])
+                        del self._buffer[:end]
+                        return data
+                self.recv()
+        except socket.timeout:
+            data = bytes(self._buffer)
+            self._buffer = bytearray()
+            logger.debug('Socket read operation terminated via timeout, data {}.'.format(data))
+            if self.socket_read_payload_length:
+                # Partial frame, never forward it with its length header
+                return b''
+            return data
+
+    def accept(self, conn):
+        """ Take over a connected socket. """
+        self.conn = conn
+        self._buffer = bytearray()
+        self.conn.setblocking(True)
+        self.conn.settimeout(self.socket_timeout)
+
+    def serve(self, addr):
+        """ Serve the accepted connection until it is closed. """
+        try:
+            with self.conn:
+                logger.info('Connected to the socket {} {} {}'.format(self.socket_path, self.conn, addr))
+                super().start()
+        except ConnectionError:
+            logger.info('The connection with the socket {} {} has been closed.'.format(self.socket_path, addr))
+        except:
+            logger.exception('The connection with the socket {} {} has been closed.'.format(self.socket_path, addr))
 
     def start(self):
         logger.info(self.__str__())
@@ -116,12 +415,153 @@ class STREAMSocketMaster(BaseMaster):
             logger.info('Unix Socket {}: Waiting for a connection'.format(self.socket_path))
 
             while True:
-                self.conn, addr = s.accept()
-                self.conn.setblocking(True)
-                self.conn.settimeout(self.socket_timeout)
-                try:
-                    with self.conn:
-                        logger.info('Connected to the unix socket {} {} {}'.format(self.socket_path, self.conn, addr))
-                        super().start()
-                except:
-                    logger.exception('The connection with the unix socket {} has been closed.'.format(self.socket_path))
+                conn, addr = s.accept()
+                self.accept(conn)
+                self.serve(addr)
+
+
+class STREAMTCPMaster:
+    """
+    TCP listener serving many IOC connections on one port, each in its own thread. Framing, settings handling and the
+    redis path are the ones of STREAMSocketMaster. A connection starts with the handshake 'EP|<endpoint>|PE', framed
+    like any other message, which is answered with OK, or ERR before closing if the endpoint is not served here.
+
+    Connections sharing an endpoint are serialized by a per-endpoint lock. With admission control, max_in_flight
+    bounds how many of their requests may be waiting for it: max_in_flight 1 answers BUSY to any overlapping request.
+    """
+
+    def __init__(self, host: str, port: int,
+                 redis_manager_factory,
+                 endpoints: list = None,
+                 admission: AdmissionController = None,
+                 tcp_nodelay: bool = True,
+                 tcp_keepalive: bool = True,
+                 tcp_keepalive_idle: int = 60,
+                 tcp_keepalive_interval: int = 10,
+                 tcp_keepalive_count: int = 3,
+                 socket_backlog: int = 128,
+                 socket_reconnect_interval: int = 30,
+                 socket_terminator: bytes = None,
+                 socket_buffer: int = 4096,
+                 socket_timeout: int = 5,
+                 socket_read_payload_length: bool = False,
+                 socket_trim_terminator: bool = True
+                 ):
+        """
+        :param host: Address to bind.
+        :param port: Port to bind.
+        :param redis_manager_factory: Callable returning a new RedisManager for an endpoint. Called once per
+                                      connection, a RedisManager must not be shared between threads.
+        :param endpoints: Endpoints accepted by the handshake, any if None.
+        :param admission: Admission controller shared by all connections, requests are never shed if None.
+        :param tcp_nodelay: Disable Nagle's algorithm.
+        :param tcp_keepalive: Enable TCP keep-alive, idle, interval and count in seconds/probes.
+        :param socket_backlog: Listen backlog.
+        """
+        self.host = host
+        self.port = port
+        self.redis_manager_factory = redis_manager_factory
+        self.endpoints = set(endpoints) if endpoints is not None else None
+        self.admission = admission if admission else AdmissionController()
+        self.tcp_nodelay = tcp_nodelay
+        self.tcp_keepalive = tcp_keepalive
+        self.tcp_keepalive_idle = tcp_keepalive_idle
+        self.tcp_keepalive_interval = tcp_keepalive_interval
+        self.tcp_keepalive_count = tcp_keepalive_count
+        self.socket_backlog = socket_backlog
+        self.socket_reconnect_interval = socket_reconnect_interval
+        self.socket_terminator = socket_terminator
+        self.socket_buffer = socket_buffer
+        self.socket_timeout = socket_timeout
+        self.socket_read_payload_length = socket_read_payload_length
+        self.socket_trim_terminator = socket_trim_terminator
+
+        self._endpoint_locks = {}
+        self._endpoint_locks_lock = threading.Lock()
+
+    def get_endpoint_lock(self, endpoint: str):
+        with self._endpoint_locks_lock:
+            if endpoint not in self._endpoint_locks:
+                self._endpoint_locks[endpoint] = threading.Lock()
+            return self._endpoint_locks[endpoint]
+
+    def set_socket_options(self, conn: socket.socket):
+        if self.tcp_nodelay:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.tcp_keepalive:
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self.tcp_keepalive_idle)
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, self.tcp_keepalive_interval)
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, self.tcp_keepalive_count)
+
+    def handshake(self, handler: STREAMSocketMaster):
+        """ Read the handshake, return the endpoint or None if refused. """
+        data = handler.get_from_device()
+        # Kept when trim_terminator is disabled
+        if handler.socket_terminator and data.endswith(handler.socket_terminator):
+            data = data[:-len(handler.socket_terminator)]
+        if not (data.startswith(HANDSHAKE_PREFIX) and data.endswith(HANDSHAKE_SUFFIX)):
+            logger.warning('{}: invalid handshake {}.'.format(handler.socket_path, data))
+            return None
+
+        endpoint = data[len(HANDSHAKE_PREFIX):-len(HANDSHAKE_SUFFIX)].decode('utf-8', 'replace')
+        if self.endpoints is not None and endpoint not in self.endpoints:
+            logger.warning('{}: unknown endpoint {}.'.format(handler.socket_path, endpoint))
+            return None
+        return endpoint
+
+    def handle(self, conn: socket.socket, addr):
+        handler = STREAMSocketMaster('tcp://{}:{}'.format(addr[0], addr[1]),
+                                     redis_manager=None,
+                                     admission=self.admission,
+                                     socket_reconnect_interval=self.socket_reconnect_interval,
+                                     socket_terminator=self.socket_terminator,
+                                     socket_buffer=self.socket_buffer,
+                                     socket_timeout=self.socket_timeout,
+                                     socket_read_payload_length=self.socket_read_payload_length,
+                                     socket_trim_terminator=self.socket_trim_terminator)
+        try:
+            self.set_socket_options(conn)
+            handler.accept(conn)
+            endpoint = self.handshake(handler)
+        except (OSError, ValueError):
+            logger.exception('{}: handshake failed.'.format(handler.socket_path))
+            conn.close()
+            return
+
+        if endpoint is None:
+            try:
+                handler.send_to_device(HANDSHAKE_ERR)
+            except OSError:
+                logger.info('{}: closed before the handshake was refused.'.format(handler.socket_path))
+            finally:
+                conn.close()
+            return
+
+        handler.redis_manager = self.redis_manager_factory(endpoint)
+        handler.endpoint_lock = self.get_endpoint_lock(endpoint)
+        handler.socket_path += '/' + endpoint
+        try:
+            try:
+                handler.send_to_device(HANDSHAKE_OK)
+            except OSError:
+                logger.info('{}: closed before the handshake was accepted.'.format(handler.socket_path))
+                conn.close()
+                return
+            handler.serve(addr)
+        finally:
+            # The RedisManager lives as long as the connection, write what it has not written yet
+            handler.redis_manager.stats.close()
+
+    def start(self):
+        logger.info(self.__str__())
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind((self.host, self.port))
+            s.listen(self.socket_backlog)
+            logger.info('TCP Socket {}:{}: Waiting for connections'.format(self.host, self.port))
+
+            while True:
+                conn, addr = s.accept()
+                threading.Thread(target=self.handle, args=(conn, addr), daemon=True).start()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+import json
+import logging
+import random
+import time
+
+import redis
+
+logger = logging.getLogger()
+
+MONITOR_SUFFIX = '#monitor'
+
+
+def payload_summary(payload, max_payload: int):
+    """ Printable, size capped representation of a payload. """
+    if payload is None:
+        return None
+    if type(payload) != bytes:
+        payload = str(payload).encode('utf-8')
+    return payload[:max_payload].decode('ascii', 'backslashreplace')
+
+
+class MonitorTap:
+    """
+    Read-only fan-out of request/reply summaries for a single endpoint.
+
+    Summaries are published to the '<stream_name>#monitor' channel. The channel is only fed while there is at least
+    one subscriber: PUBLISH returns the number of receivers (pattern subscribers included), when it returns zero the
+    tap stays quiet and only probes the channel again after probe_interval seconds.
+    """
+
+    def __init__(self, connection: redis.Redis, stream_name: str, role: str = 'master', client_id: str = None,
+                 sample_rate: float = 1., max_payload: int = 256, probe_interval: float = 1.):
+        """
+        :param connection: Redis connection used to publish.
+        :param stream_name: Endpoint name.
+        :param role: Who is publishing, 'master' or 'slave'.
+        :param client_id: Optional publisher identification.
+        :param sample_rate: Fraction of the transactions published while there are subscribers, between 0 and 1.
+        :param max_payload: Maximum number of bytes of each payload carried by a summary.
+        :param probe_interval: Seconds between publish attempts while nobody is listening.
+        """
+        self.connection = connection
+        self.stream_name = stream_name
+        self.channel = stream_name + MONITOR_SUFFIX
+        self.role = role
+        self.client_id = client_id
+        self.sample_rate = min(max(sample_rate, 0.), 1.)
+        self.max_payload = max_payload
+        self.probe_interval = probe_interval
+
+        self._listeners = 0
+        self._next_probe = 0.
+
+    def publish(self, request: bytes, reply: bytes, latency: float):
+        """ Publish a transaction summary if someone is watching. Never raises. """
+        if self.sample_rate <= 0.:
+            return
+
+        now = time.time()
+        if not self._listeners and now < self._next_probe:
+            return
+
+        if self.sample_rate < 1. and random.random() >= self.sample_rate:
+            return
+
+        summary = json.dumps({
+            'endpoint': self.stream_name,
+            'role': self.role,
+            'id': self.client_id,
+            'ts': now,
+            'latency': latency,
+            'timeout': not reply,
+            'request_len': len(request) if request else 0,
+            'reply_len': len(reply) if reply else 0,
+            'request': payload_summary(request, self.max_payload),
+            'reply': payload_summary(reply, self.max_payload),
+        })
+        try:
+            self._listeners = self.connection.publish(self.channel, summary)
+        except redis.exceptions.RedisError:
+            logger.debug('Monitor tap {}: publish failed.'.format(self.channel))
+            self._listeners = 0
+
+        if not self._listeners:
+            self._next_probe = now + self.probe_interval
+
+
+class EndpointRate:
+    """ Running figures for one endpoint/role pair displayed by the monitor. """
+
+    def __init__(self):
+        self.count = 0
+        self.timeouts = 0
+        self.latency_sum = 0.
+        self.latency_max = 0.
+
+    def add(self, summary: dict):
+        self.count += 1
+        if summary['timeout']:
+            self.timeouts += 1
+        self.latency_sum += summary['latency']
+        self.latency_max = max(self.latency_max, summary['latency'])
+
+
+def monitor(connection: redis.Redis, patterns: list, interval: float = 1., show_payloads: bool = False):
+    """
+    Subscribe to the monitor channels of all endpoints matching the glob patterns and log live rates and latencies.
+
+    :param connection: Redis connection.
+    :param patterns: Endpoint glob patterns, e.g. 'uhv:*'.
+    :param interval: Seconds between rate reports.
+    :param show_payloads: Log every summary received, including payloads.
+    """
+    p = connection.pubsub()
+    p.psubscribe(*[pattern + MONITOR_SUFFIX for pattern in patterns])
+    logger.info('Monitoring {}'.format(', '.join(patterns)))
+
+    rates = {}
+    tini = time.time()
+    while True:
+        message = p.get_message(ignore_subscribe_messages=True, timeout=interval)
+        if message:
+            try:
+                summary = json.loads(message['data'])
+            except ValueError:
+                logger.warning('Invalid monitor message {}'.format(message['data']))
+                continue
+
+            key = (summary['endpoint'], summary['role'])
+            if key not in rates:
+                rates[key] = EndpointRate()
+            rates[key].add(summary)
+
+            if show_payloads:
+                logger.info('{} {} {} {:.3f}ms {} -> {}'.format(
+                    summary['endpoint'], summary['role'], summary['id'] or '', summary['latency'] * 1000.,
+                    summary['request'], summary['reply']))
+
+        elapsed = time.time() - tini
+        if elapsed >= interval:
+            for (endpoint, role), rate in sorted(rates.items()):
+                logger.info('{} {}: {:.1f} req/s, avg {:.3f}ms, max {:.3f}ms, {} timeouts'.format(
+                    endpoint, role, rate.count / elapsed,
+                    rate.latency_sum / rate.count * 1000., rate.latency_max * 1000., rate.timeouts))
+            rates = {}
+            tini = time.time()
@@ -1,15 +1,46 @@
 #!/usr/bin/env python3
 import logging
+import select
 import serial
 import time
 import termios
 import os
 
 import zerg.common
+import zerg.framing
 
 logger = logging.getLogger()
 
 
+READ_PROFILE_CACHE_SIZE = 64
+
+
+class ReadProfile:
+    """ Read parameters of a serial transaction, compiled once from a device_comm_settings dictionary. """
+
+    def __init__(self, settings: dict, operation_timeout: float, read_timeout: float, terminator: bytes = None,
+                 frame: dict = None, baudrate: int = 9600):
+        """
+        :param settings: StreamDevice like settings, ReplyTimeout and ReadTimeout in milliseconds. An optional 'Frame'
+                         entry selects the frame completion strategy, see zerg.framing.get_frame.
+        :param operation_timeout: Default operation timeout in seconds.
+        :param read_timeout: Default read timeout in seconds.
+        :param terminator: Default read terminator.
+        :param frame: Default frame completion strategy.
+        :param baudrate: Port baud rate.
+        """
+        self.operation_timeout = settings['ReplyTimeout'] / 1000 if 'ReplyTimeout' in settings else operation_timeout
+        self.read_timeout = settings['ReadTimeout'] / 1000 if 'ReadTimeout' in settings else read_timeout
+        self.max_input = settings['MaxInput'] if 'MaxInput' in settings else -1
+        self.terminator = settings['Terminator'].encode('utf-8') if 'Terminator' in settings else terminator
+        self.frame = zerg.framing.get_frame(settings['Frame'] if 'Frame' in settings else frame,
+                                            terminator=self.terminator, baudrate=baudrate)
+
+    def __str__(self):
+        return 'ReadProfile(operation_timeout={}, read_timeout={}, max_input={}, frame={})'.format(
+            self.operation_timeout, self.read_timeout, self.max_input, self.frame)
+
+
 class BaseSlave:
     """ Base slave object for synchronous communication. """
 
@@ -19,6 +50,10 @@ class BaseSlave:
 
         self.redis_manager = redis_manager
         self.redis_manager.slave_priority = priority
+        self.redis_manager.slave_client_id = client_id
+        self.redis_manager.monitor.role = 'slave'
+        self.redis_manager.monitor.client_id = client_id
+        self.redis_manager.stats.role = 'slave'
 
     def start(self):
         self.redis_manager.slave_alive_signal_start()
@@ -38,7 +73,11 @@ class SerialSlave(BaseSlave):
                  serial_operation_timeout: float = 1.25,
                  serial_read_terminator=None,
                  serial_read_timeout: float = 0.5,
-                 serial_write_timeout: float = 2):
+                 serial_write_timeout: float = 2,
+                 serial_frame: dict = None):
+        """
+        :param serial_frame: Default frame completion strategy, see zerg.framing.get_frame. Terminator based if None.
+        """
 
         super().__init__(redis_manager, client_id, priority)
 
@@ -46,15 +85,17 @@ class SerialSlave(BaseSlave):
         self.serial_baudrate = serial_baudrate
         self.serial_device = serial_device
         self.serial_operation_timeout = serial_operation_timeout
-        if serial_read_terminator:
-            self.serial_read_terminator = list(serial_read_terminator)
-            self.serial_read_terminator_len = len(self.serial_read_terminator)
-        else:
-            self.serial_read_terminator = None
+        self.serial_read_terminator = bytes(serial_read_terminator) if serial_read_terminator else None
         self.serial_read_timeout = serial_read_timeout
         self.serial_buffer = serial_buffer
+        self.serial_frame = serial_frame
         self.ser = None
 
+        # Compiled read profiles by settings fingerprint, plus the last settings dict seen for a cheap identity check
+        self._read_profiles = {}
+        self._read_profile_settings = None
+        self._read_profile = None
+
     def start(self):
         self.connect()
         super().start()
@@ -73,55 +114,85 @@ class SerialSlave(BaseSlave):
             write_timeout=self.serial_write_timeout)
         logger.info('Connected at {}'.format(self.ser))
 
+    def get_read_profile(self, settings: dict):
+        """ Return the read profile for these settings, compiling it only for a settings fingerprint not seen yet. """
+        if settings is self._read_profile_settings:
+            return self._read_profile
+
+        fingerprint = repr(sorted(settings.items()))
+        profile = self._read_profiles.get(fingerprint)
+        if profile is None:
+            if len(self._read_profiles) >= READ_PROFILE_CACHE_SIZE:
+                self._read_profiles.clear()
+            profile = ReadProfile(settings,
+                                  operation_timeout=self.serial_operation_timeout,
+                                  read_timeout=self.serial_read_timeout,
+                                  terminator=self.serial_read_terminator,
+                                  frame=self.serial_frame,
+                                  baudrate=self.serial_baudrate)
+            self._read_profiles[fingerprint] = profile
+            logger.debug('Ser: New read profile {}'.format(profile))
+
+        self._read_profile_settings = settings
+        self._read_profile = profile
+        return profile
+
+    def apply_read_profile(self, profile):
+        """ Touch the port parameters only when they change, each assignment reconfigures the port via termios. """
+        if self.ser.timeout != profile.read_timeout:
+            self.ser.timeout = profile.read_timeout
+
     def downstream_action(self, data: bytes, settings={}):
-        res = []
+        res = bytearray()
         if not self.ser:
             self.connect()
         try:
-            self.ser.flushInput()
-            self.ser.flushOutput()
-            self.ser.write(data)
+            profile = self.get_read_profile(settings)
+            self.apply_read_profile(profile)
 
-            operation_timeout = settings[
-                                    'ReplyTimeout'] / 1000 if 'ReplyTimeout' in settings else self.serial_operation_timeout
-            read_timeout = settings['ReadTimeout'] / 1000 if 'ReadTimeout' in settings else self.serial_read_timeout
-            max_input = settings['MaxInput'] if 'MaxInput' in settings else -1
-
-            serial_use_terminator = ('Terminator' in settings) or (self.serial_read_terminator is not None)
-            if serial_use_terminator:
-                terminator = list(settings['Terminator'].encode('utf-8')) if 'Terminator' in settings else self.serial_read_terminator
-                terminator_len = len(terminator)
-
-            self.ser.timeout = read_timeout
+            self.ser.reset_input_buffer()
+            self.ser.write(data)
 
             tini = time.time()
+            frame = profile.frame
+            frame.reset()
 
             while True:
-                b = self.ser.read(1)
+                if frame.gap is not None and res:
+                    ready, _, _ = select.select([self.ser], [], [], frame.gap)
+                    if not ready:
+                        logger.debug('Ser: Inter-byte gap {}s'.format(frame.gap))
+                        break
+                    size = max(self.ser.in_waiting, 1)
+                else:
+                    size = frame.remaining(res)
+
+                if profile.max_input > 0:
+                    size = min(size, profile.max_input - len(res))
+
+                b = self.ser.read(size)
 
                 if b == b'':
-                    logger.warning('Ser: Read timeout {}s'.format(read_timeout))
+                    logger.warning('Ser: Read timeout {}s'.format(profile.read_timeout))
                     break
 
-                if time.time() - tini > operation_timeout:
-                    logger.warning('Ser: Operation timeout {}s'.format(operation_timeout))
+                if time.time() - tini > profile.operation_timeout:
+                    logger.warning('Ser: Operation timeout {}s'.format(profile.operation_timeout))
                     break
 
-                res.append(b)
+                res += b
 
-                if len(res) == max_input:
-                    # ser_continue = False
-                    logger.debug('Ser: MaxInput {}'.format(max_input))
+                if len(res) == profile.max_input:
+                    logger.debug('Ser: MaxInput {}'.format(profile.max_input))
                     break
 
-                if serial_use_terminator and len(res) >= len(terminator):
-                    if res[-terminator_len:] == terminator:
-                        logger.debug('Ser: Terminator')
-                        break
+                if frame.feed(res, b):
+                    logger.debug('Ser: {}'.format(frame))
+                    break
 
         except termios.error:
             logger.exception('Serial exception, closing connection.')
             self.ser.close()
             self.ser = None
 
-        return b''.join(res)
+        return bytes(res)
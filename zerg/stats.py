@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+import logging
+import threading
+import time
+
+import redis
+
+logger = logging.getLogger()
+
+STATS_SUFFIX = '#stats#'
+ENDPOINTS = 'zerg#stats#endpoints'
+ROLES = ('master', 'slave')
+
+# Latency histogram upper bounds in milliseconds, the last bucket is unbounded
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+LATENCY_FIELDS = tuple('lat_le_{}'.format(b) for b in LATENCY_BUCKETS) + ('lat_le_inf',)
+
+
+def latency_field(latency: float):
+    ms = latency * 1000
+    for bucket, field in zip(LATENCY_BUCKETS, LATENCY_FIELDS):
+        if ms <= bucket:
+            return field
+    return LATENCY_FIELDS[-1]
+
+
+def stats_key(stream_name: str, role: str, bucket: int):
+    return '{}{}{}#{}'.format(stream_name, STATS_SUFFIX, role, bucket)
+
+
+class StatsRecorder:
+    """
+    Per-endpoint statistics rolled up in time buckets.
+
+    Each bucket is the redis hash '<stream_name>#stats#<role>#<bucket start>' holding integer counters: count,
+    timeouts, shed, bytes_in, bytes_out, busy_us (sum of latencies, in microseconds) and the latency histogram
+    LATENCY_FIELDS. Buckets expire after retention buckets, so the store size per endpoint is fixed. Measurements are
+    accumulated in memory, recording never touches redis. Once started, a daemon thread writes them in a single
+    pipeline every flush_interval seconds, close() writes what is left.
+    """
+
+    def __init__(self, connection: redis.Redis, stream_name: str, role: str = 'master', bucket: int = 60,
+                 retention: int = 1440, flush_interval: float = 5.):
+        """
+        :param connection: Redis connection.
+        :param stream_name: Endpoint name.
+        :param role: 'master' or 'slave'.
+        :param bucket: Bucket length in seconds.
+        :param retention: Number of buckets kept, disabled if <= 0.
+        :param flush_interval: Seconds between writes to redis.
+        """
+        self.connection = connection
+        self.stream_name = stream_name
+        self.role = role
+        self.bucket = bucket
+        self.retention = retention
+        self.flush_interval = flush_interval
+
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._worker = None
+
+    def _fields(self, now: float):
+        start = int(now // self.bucket * self.bucket)
+        fields = self._pending.get(start)
+        if fields is None:
+            fields = self._pending[start] = {}
+        return fields
+
+    def record(self, latency: float, bytes_in: int, bytes_out: int, timeout: bool):
+        """
+        :param latency: Transaction duration in seconds.
+        :param bytes_in: Request size.
+        :param bytes_out: Reply size.
+        :param timeout: True if there was no reply.
+        """
+        if self.retention <= 0:
+            return
+
+        with self._lock:
+            fields = self._fields(time.time())
+            for field, value in (('count', 1), ('timeouts', 1 if timeout else 0), ('bytes_in', bytes_in),
+                                 ('bytes_out', bytes_out), ('busy_us', int(latency * 1e6)),
+                                 (latency_field(latency), 1)):
+                fields[field] = fields.get(field, 0) + value
+
+    def record_shed(self):
+        """ A request answered as busy without being forwarded. """
+        if self.retention <= 0:
+            return
+
+        with self._lock:
+            fields = self._fields(time.time())
+            fields['shed'] = fields.get('shed', 0) + 1
+
+    def start(self):
+        """ Start the periodic flush. """
+        if self.retention <= 0 or self._worker is not None:
+            return
+        self._worker = threading.Thread(target=self.flush_worker, daemon=True)
+        self._worker.start()
+
+    def flush_worker(self):
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        """ Stop the periodic flush and write the pending measurements. """
+        self._closed.set()
+        self.flush()
+
+    def flush(self):
+        """ Write the pending measurements. They are dropped if redis is not reachable. """
+        with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+
+        pipeline = self.connection.pipeline(transaction=False)
+        for start, fields in pending.items():
+            key = stats_key(self.stream_name, self.role, start)
+            for field, value in fields.items():
+                if value:
+                    pipeline.hincrby(key, field, value)
+            pipeline.expire(key, self.bucket * self.retention)
+        pipeline.sadd(ENDPOINTS, self.stream_name)
+        try:
+            pipeline.execute()
+        except redis.exceptions.RedisError:
+            logger.warning('Unable to write statistics of {}.'.format(self.stream_name))
+
+
+class EndpointReport:
+    """ Statistics of one endpoint and role summed over a time window. """
+
+    def __init__(self, endpoint: str, role: str, window: float):
+        self.endpoint = endpoint
+        self.role = role
+        self.window = window
+        self.fields = {}
+        # Requests shed by the master, whatever the role reported
+        self.shed = 0
+
+    def add(self, fields: dict):
+        for field, value in fields.items():
+            field = field.decode('utf-8')
+            self.fields[field] = self.fields.get(field, 0) + int(value)
+
+    @property
+    def count(self):
+        return self.fields.get('count', 0)
+
+    @property
+    def utilization(self):
+        """ Fraction of the window spent in transactions, bus utilization for the slave. """
+        return self.fields.get('busy_us', 0) / 1e6 / self.window
+
+    def percentile(self, p: float):
+        """ Latency percentile in ms, as the upper bound of the histogram bucket. Infinite for the last bucket. """
+        if not self.count:
+            return 0.
+        target = self.count * p
+        total = 0
+        for bucket, field in zip(LATENCY_BUCKETS + (float('inf'),), LATENCY_FIELDS):
+            total += self.fields.get(field, 0)
+            if total >= target:
+                return bucket
+        return float('inf')
+
+
+def report(connection: redis.Redis, window: float = 3600., bucket: int = 60, role: str = 'slave', top: int = 20):
+    """
+    Rank endpoints by utilization and tail latency over the last window seconds.
+
+    :param connection: Redis connection.
+    :param window: Seconds covered by the report.
+    :param bucket: Bucket length the statistics were recorded with.
+    :param role: 'slave' for bus utilization, 'master' for end to end figures.
+    :param top: Number of endpoints listed.
+    :return: The EndpointReport list, ranked.
+    """
+    endpoints = sorted(e.decode('utf-8') for e in connection.smembers(ENDPOINTS))
+    now = int(time.time() // bucket * bucket)
+    starts = range(now - int(window // bucket) * bucket + bucket, now + bucket, bucket)
+
+    pipeline = connection.pipeline(transaction=False)
+    for endpoint in endpoints:
+        for start in starts:
+            pipeline.hgetall(stats_key(endpoint, role, start))
+            # Only the master sheds requests
+            pipeline.hget(stats_key(endpoint, 'master', start), 'shed')
+    results = iter(pipeline.execute())
+
+    reports = []
+    for endpoint in endpoints:
+        r = EndpointReport(endpoint, role, window)
+        for _ in starts:
+            r.add(next(results))
+            r.shed += int(next(results) or 0)
+        if r.count or r.shed:
+            reports.append(r)
+
+    reports.sort(key=lambda r: (r.utilization, r.percentile(0.99)), reverse=True)
+    return reports[:top]